@@ -0,0 +1,197 @@
+"""
+Benchmark of the import against the local fake LinguaLeo (see fake_lingualeo.py).
+
+Drives connect.Lingualeo and connect.Download the same way the add-on window does
+and reports pages/sec, media/sec and end-to-end time for accounts of different sizes.
+Anki (aqt and anki packages) has to be installed in the environment,
+but Anki itself isn't started: the add-on gets a minimal main window
+with a temporary add-on folder and media folder.
+
+    python bench_import.py --sizes 1000 10000 50000 --latency 0.02
+    python bench_import.py --engine asyncio --https --json results.json
+"""
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import fake_lingualeo
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'lingualeoanki'
+
+
+class BenchMainWindow(object):
+    """
+    The part of Anki's main window used by the import
+    """
+
+    def __init__(self, root):
+        self.pm = types.SimpleNamespace(addonFolder=lambda: os.path.join(root, 'addons'))
+        media_dir = os.path.join(root, 'collection.media')
+        os.makedirs(media_dir)
+        self.col = types.SimpleNamespace(media=types.SimpleNamespace(dir=lambda: media_dir))
+
+
+def load_addon(root, settings):
+    """
+    Import add-on modules without running its __init__, which adds a menu item to Anki
+    :param settings: values to override in config.json
+    :return: tuple of modules (connect, utils, report)
+    """
+    import aqt
+    aqt.mw = BenchMainWindow(root)
+    addon_dir = os.path.join(root, 'addons', PACKAGE)
+    os.makedirs(addon_dir)
+    with open(os.path.join(REPO_DIR, PACKAGE, 'config.json')) as f:
+        config = json.load(f)
+    config.update(settings)
+    with open(os.path.join(addon_dir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    for name in list(sys.modules):
+        if name == PACKAGE or name.startswith(PACKAGE + '.'):
+            del sys.modules[name]
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [os.path.join(REPO_DIR, PACKAGE)]
+    sys.modules[PACKAGE] = package
+    return tuple(importlib.import_module(PACKAGE + '.' + name) for name in ('connect', 'utils', 'report'))
+
+
+def make_certificate(folder):
+    """
+    Create self-signed certificate for HTTPS with openssl command
+    :return: tuple (certificate file, key file)
+    """
+    certfile = os.path.join(folder, 'cert.pem')
+    keyfile = os.path.join(folder, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=127.0.0.1', '-keyout', keyfile, '-out', certfile],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def run_benchmark(size, args):
+    root = tempfile.mkdtemp(prefix='lingualeo-bench-')
+    try:
+        settings = {'email': fake_lingualeo.EMAIL, 'password': fake_lingualeo.PASSWORD,
+                    'networkEngine': args.engine}
+        modules = load_addon(root, settings)
+        certfile, keyfile = make_certificate(root) if args.https else (None, None)
+        vocabulary = fake_lingualeo.Vocabulary(size, args.wordsets, args.sounds, args.pictures)
+        server = fake_lingualeo.FakeLingualeo(vocabulary, latency=args.latency, error_rate=args.error_rate,
+                                              max_per_page=args.max_per_page, media_size=args.media_size,
+                                              certfile=certfile, keyfile=keyfile,
+                                              compress=not args.no_compress).start()
+        try:
+            return measure(modules, server, size)
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def measure(modules, server, size):
+    connect, utils, report = modules
+    errors = []
+    started = time.time()
+    lingualeo = connect.Lingualeo(fake_lingualeo.EMAIL, fake_lingualeo.PASSWORD,
+                                  utils.get_cookies_path())
+    lingualeo.url_prefix = server.url_prefix
+    if server.https:
+        # Self-signed certificate
+        lingualeo.transport.set_unverified(True)
+    lingualeo.Error.connect(errors.append)
+    wordsets = lingualeo.get_wordsets()
+    if wordsets is None:
+        raise RuntimeError('Failed to get wordsets: %s' % errors)
+
+    # Pages only, without media
+    pages_started = time.time()
+    pages = 0
+    words = 0
+    for page in connect.WordPages(lingualeo, 'all'):
+        pages += 1
+        words += len(page)
+    pages_time = time.time() - pages_started
+
+    # The whole import: pages and media downloaded at the same time
+    received = []
+    stats_before = dict(server.stats)
+    download = connect.Download(connect.WordPages(lingualeo, 'all'), lingualeo.transport,
+                                lingualeo.retry_policy, utils.MediaCache(), None, None,
+                                lingualeo.get_async_engine(), lingualeo.media_planner)
+    download.Words.connect(received.extend)
+    download.Error.connect(errors.append)
+    import_report = report.start_report()
+    import_started = time.time()
+    # Run in this thread, media is still downloaded by the workers
+    download.run()
+    import_time = time.time() - import_started
+    media = server.stats.get('media', 0) - stats_before.get('media', 0)
+    return {'words': size,
+            'engine': 'asyncio' if lingualeo.async_engine else 'threads',
+            'pages': pages,
+            'pages_per_sec': pages / pages_time if pages_time else 0,
+            'words_per_sec': words / pages_time if pages_time else 0,
+            'media': media,
+            'media_per_sec': media / import_time if import_time else 0,
+            'imported': len(received),
+            'problem_words': len(download.failed),
+            'import_time': import_time,
+            'total_time': time.time() - started,
+            'server_errors': server.stats.get('errors', 0),
+            'errors': [error[:200] for error in errors],
+            'report': import_report.to_dict()}
+
+
+def print_results(results):
+    row = '{:>7} {:>8} {:>6} {:>10} {:>7} {:>10} {:>9} {:>9} {:>9}'
+    print(row.format('words', 'engine', 'pages', 'pages/s', 'media', 'media/s', 'problems', 'import,s', 'total,s'))
+    for r in results:
+        print(row.format(r['words'], r['engine'], r['pages'], '%.1f' % r['pages_per_sec'], r['media'],
+                         '%.1f' % r['media_per_sec'], r['problem_words'], '%.2f' % r['import_time'],
+                         '%.2f' % r['total_time']))
+        print('    ' + ', '.join('%s %.2f s' % (name, phase['seconds'])
+                                  for name, phase in sorted(r['report']['phases'].items())))
+        requests = r['report']['requests']
+        print('    requests %d, p50 %.3f s, p90 %.3f s, p99 %.3f s, %.1f MB (%.1f MB received)'
+              % (requests['count'], requests['p50'], requests['p90'], requests['p99'],
+                 requests['bytes'] / 1048576.0, requests['raw_bytes'] / 1048576.0))
+        for error in r['errors']:
+            print('    ' + error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import against fake LinguaLeo')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help='numbers of words in the accounts')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--https', action='store_true', help='serve HTTPS (pictures are sent only with HTTPS)')
+    parser.add_argument('--wordsets', type=int, default=5)
+    parser.add_argument('--sounds', type=int, help='number of distinct sounds')
+    parser.add_argument('--pictures', type=int, help='number of distinct pictures')
+    parser.add_argument('--latency', type=float, default=0.0, help='average delay of responses (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='part of requests failed with 503')
+    parser.add_argument('--max-per-page', type=int, help='page size limit of the server')
+    parser.add_argument('--media-size', type=int, default=4096)
+    parser.add_argument('--no-compress', action='store_true', help="don't gzip JSON responses")
+    parser.add_argument('--json', help='file to save the results to')
+    args = parser.parse_args()
+    results = []
+    for size in args.sizes:
+        results.append(run_benchmark(size, args))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+"""
+Local stand-in for LinguaLeo to measure the import without the real service.
+
+Serves the endpoints used by the add-on in the same shapes as LinguaLeo does:
+login and isauthorized (api.lingualeo.com), GetWordSets and GetWords
+(mobile-api.lingualeo.com) and media files (sounds and pictures).
+Requests are routed by the path, so the add-on works with it after
+its url_prefix is replaced with the server's one, e.g. 'http://127.0.0.1:8000/'.
+
+Latency, error rate, page size limit, compression of JSON responses
+and size of the vocabulary are tunable.
+Run it standalone to try the add-on by hand:
+
+    python fake_lingualeo.py --words 10000 --latency 0.05 --error-rate 0.01
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+EMAIL = 'bench@example.com'
+PASSWORD = 'bench'
+STATUSES = ('new', 'learning', 'learned')
+
+
+class Vocabulary(object):
+    """
+    Generated words and wordsets of a fake account.
+    The same arguments always give the same vocabulary
+    """
+
+    def __init__(self, words=1000, wordsets=5, sounds=None, pictures=None, seed=0):
+        """
+        :param words: number of words in the main dictionary
+        :param wordsets: number of user dictionaries besides the main one
+        :param sounds: number of distinct sound files, by default every word has its own
+        :param pictures: number of distinct pictures, by default every word has its own
+        """
+        self.size = words
+        self.sounds = sounds or words
+        self.pictures = pictures or words
+        rnd = random.Random(seed)
+        now = int(time.time())
+        self.words = []
+        for i in range(words):
+            self.words.append({'id': i + 1,
+                               'wd': 'word%d' % i,
+                               'scr': 'wɜːd%d' % i,
+                               # Newest words first, as LinguaLeo sorts them by 'created'
+                               'created': now - i * 60,
+                               'status': STATUSES[i % len(STATUSES)],
+                               'sound': i % self.sounds,
+                               'picture': i % self.pictures,
+                               'wordSets': sorted(rnd.sample(range(2, wordsets + 2), min(wordsets, 2)))
+                               if wordsets else []})
+        self.wordsets = [{'id': 1, 'name': 'My dictionary', 'countWords': words}]
+        for wordset_id in range(2, wordsets + 2):
+            count = sum(1 for word in self.words if wordset_id in word['wordSets'])
+            self.wordsets.append({'id': wordset_id, 'name': 'Wordset %d' % wordset_id, 'cw': count})
+
+    def select(self, status='all', wordset_ids=None):
+        words = self.words
+        if status and status != 'all':
+            words = [word for word in words if word['status'] == status]
+        if wordset_ids and 1 not in wordset_ids:
+            wordset_ids = set(wordset_ids)
+            words = [word for word in words if wordset_ids.intersection(word['wordSets'])]
+        return words
+
+
+class FakeLingualeo(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Keep-alive clients open many connections at once
+    request_queue_size = 128
+
+    def __init__(self, vocabulary, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 max_per_page=None, media_size=4096, certfile=None, keyfile=None, compress=True, seed=0):
+        """
+        :param latency: average delay of every response (seconds)
+        :param error_rate: part of requests answered with 503 Service Unavailable
+        :param max_per_page: maximum words in a page, bigger perPage is silently capped
+        :param media_size: size of every media file (bytes)
+        :param certfile: certificate to serve HTTPS, plain HTTP is used without it
+        :param compress: gzip JSON responses if the client accepts it
+        """
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.vocabulary = vocabulary
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_per_page = max_per_page
+        self.compress = compress
+        self.media_body = b'\0' * media_size
+        self.https = bool(certfile)
+        if certfile:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(certfile, keyfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.token = None
+        self.stats = {}
+        self.thread = None
+
+    @property
+    def url_prefix(self):
+        host, port = self.server_address[:2]
+        return '%s://%s:%d/' % ('https' if self.https else 'http', host, port)
+
+    def media_url(self, kind, number):
+        host, port = self.server_address[:2]
+        if kind == 'picture':
+            # LinguaLeo sends pictures without the scheme
+            return '//%s:%d/media/pic/%d.png' % (host, port, number)
+        return '%s://%s:%d/media/sound/%d.mp3' % ('https' if self.https else 'http', host, port, number)
+
+    def make_word(self, word):
+        """
+        Word in the shape of GetWords response
+        """
+        translation = {'tr': 'перевод %d' % word['id'],
+                       'ctx': 'Context of %s' % word['wd'],
+                       # Add-on requests pictures with https only
+                       'pics': [self.media_url('picture', word['picture'])] if self.https else []}
+        return {'id': word['id'],
+                'wd': word['wd'],
+                'scr': word['scr'],
+                'created': word['created'],
+                'pron': self.media_url('sound', word['sound']),
+                'trs': [translation],
+                'wordSets': word['wordSets']}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def delay(self):
+        if self.latency:
+            with self.lock:
+                delay = self.random.uniform(0.5, 1.5) * self.latency
+            time.sleep(delay)
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't let them wait for delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.handle_request(self.rfile.read(length))
+
+    def handle_request(self, body):
+        server = self.server
+        path = urlsplit(self.path).path
+        server.delay()
+        if server.should_fail():
+            server.count('errors')
+            return self.send_body(b'Service Unavailable', 503, 'text/plain')
+        if path.startswith('/media/'):
+            return self.send_media(path)
+        if path.endswith('/api/login'):
+            return self.login(body)
+        if path.endswith('/api/isauthorized'):
+            return self.send_json({'is_authorized': self.get_cookie_token() == server.token})
+        try:
+            values = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            return self.send_body(b'Bad Request', 400, 'text/plain')
+        if values.get('token') != server.token or server.token is None:
+            server.count('rejected')
+            return self.send_json({'error': {'code': 401, 'msg': 'Authorization required'}})
+        if path.endswith('/GetWordSets'):
+            return self.get_wordsets(values)
+        if path.endswith('/GetWords'):
+            return self.get_words(values)
+        self.send_body(b'Not Found', 404, 'text/plain')
+
+    def login(self, body):
+        server = self.server
+        server.count('login')
+        query = parse_qs(body.decode('utf-8')) if body else parse_qs(urlsplit(self.path).query)
+        if query.get('email', [''])[0] != EMAIL or query.get('password', [''])[0] != PASSWORD:
+            return self.send_json({'error_msg': 'Invalid email or password'})
+        server.token = hashlib.sha1(str(time.time()).encode('utf-8')).hexdigest()
+        expires = time.strftime('%a, %d-%b-%Y %H:%M:%S GMT', time.gmtime(time.time() + 86400))
+        cookie = 'remember=%s; expires=%s; path=/' % (server.token, expires)
+        self.send_json({'error_msg': '', 'user': {'nickname': 'bench', 'user_id': 1}},
+                       [('Set-Cookie', cookie)])
+
+    def get_wordsets(self, values):
+        server = self.server
+        server.count('wordsets')
+        request = values.get('request', [{}])[0]
+        per_page, page = self.get_page(request)
+        items = server.vocabulary.wordsets[(page - 1) * per_page:page * per_page]
+        self.send_json({'data': [{'items': items}]})
+
+    def get_words(self, values):
+        server = self.server
+        server.count('pages')
+        per_page, page = self.get_page(values)
+        words = server.vocabulary.select(values.get('status'), values.get('wordSetIds'))
+        data = [server.make_word(word) for word in words[(page - 1) * per_page:page * per_page]]
+        server.count('words', len(data))
+        self.send_json({'data': data, 'wordSet': {'countWords': len(words)}})
+
+    def get_page(self, values):
+        per_page = int(values.get('perPage') or 100)
+        if self.server.max_per_page:
+            per_page = min(per_page, self.server.max_per_page)
+        return max(1, per_page), max(1, int(values.get('page') or 1))
+
+    def send_media(self, path):
+        server = self.server
+        etag = '"%s"' % hashlib.md5(path.encode('utf-8')).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            server.count('media_not_modified')
+            return self.send_body(b'', 304, None, [('ETag', etag)])
+        server.count('media')
+        server.count('media_bytes', len(server.media_body))
+        content_type = 'image/png' if path.endswith('.png') else 'audio/mpeg'
+        self.send_body(server.media_body, 200, content_type, [('ETag', etag)])
+
+    def get_cookie_token(self):
+        for part in (self.headers.get('Cookie') or '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'remember':
+                return value
+        return None
+
+    def send_json(self, content, headers=None):
+        body = json.dumps(content).encode('utf-8')
+        headers = list(headers or [])
+        if self.server.compress and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            self.server.count('json_bytes', len(body))
+            body = gzip.compress(body, 6)
+            headers.append(('Content-Encoding', 'gzip'))
+        self.server.count('json_sent_bytes', len(body))
+        self.send_body(body, 200, 'application/json', headers)
+
+    def send_body(self, body, status, content_type, headers=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        for name, value in headers or []:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake LinguaLeo server')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--words', type=int, default=1000)
+    parser.add_argument('--wordsets', type=int, default=5)
+    parser.add_argument('--sounds', type=int, help='number of distinct sounds')
+    parser.add_argument('--pictures', type=int, help='number of distinct pictures')
+    parser.add_argument('--latency', type=float, default=0.0, help='average delay of responses (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='part of requests failed with 503')
+    parser.add_argument('--max-per-page', type=int, help='page size limit')
+    parser.add_argument('--media-size', type=int, default=4096)
+    parser.add_argument('--cert', help='certificate file to serve HTTPS')
+    parser.add_argument('--key', help='private key of the certificate')
+    parser.add_argument('--no-compress', action='store_true', help="don't gzip JSON responses")
+    args = parser.parse_args()
+    vocabulary = Vocabulary(args.words, args.wordsets, args.sounds, args.pictures)
+    server = FakeLingualeo(vocabulary, port=args.port, latency=args.latency, error_rate=args.error_rate,
+                           max_per_page=args.max_per_page, media_size=args.media_size,
+                           certfile=args.cert, keyfile=args.key, compress=not args.no_compress)
+    print('Serving %d words at %s (email: %s, password: %s)' % (args.words, server.url_prefix, EMAIL, PASSWORD))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,495 @@
+"""
+Optional asyncio network engine (Python 3 only, i.e. Anki 2.1).
+
+The engine runs its own event loop in a separate thread and keeps
+hundreds of requests in flight without a thread per request,
+which matters on high-latency connections. Pages of words and media
+are reported back through the same interfaces as the thread-based
+PageFetcher and MediaDownloader, so Download and its Qt signals
+don't depend on the engine used. If the engine can't be used
+(Python 2, proxy is configured), the thread-based engine is used instead.
+"""
+
+import asyncio
+import io
+import json
+import socket
+import threading
+import time
+import zlib
+
+from .six.moves import queue
+from .six.moves import urllib
+from . import utils
+from .transport import Decoder, Transport
+from .connect import PageFetcher, is_auth_error, parse_words
+from .report import get_report
+
+
+class AsyncResponse(object):
+    """
+    Response with the whole body, which also works as a file-like object
+    for utils.save_media_response()
+    """
+
+    def __init__(self, status, reason, headers, body, raw_size=None):
+        """
+        :param body: decompressed body
+        :param raw_size: number of bytes received
+        """
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.raw_size = len(body) if raw_size is None else raw_size
+        self.stream = io.BytesIO(body)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self, amt=None):
+        return self.stream.read() if amt is None else self.stream.read(amt)
+
+    def close(self):
+        pass
+
+
+class AsyncHttpClient(object):
+    """
+    Minimal HTTP/1.1 client on top of asyncio streams
+    with keep-alive connections per host
+    """
+    MAX_REDIRECTS = 5
+    MAX_IDLE_PER_HOST = 32
+
+    def __init__(self, transport):
+        """
+        :param transport: Transport of the session to share SSL contexts with
+        """
+        self.transport = transport
+        self.idle = {}
+
+    async def request(self, method, url, headers=None, body=None, timeout=None, unverified=None):
+        """
+        Send request and return AsyncResponse.
+        Raises urllib.error.HTTPError for 4xx and 5xx status codes
+        and socket.timeout if there's no response in timeout seconds
+        """
+        if unverified is None:
+            unverified = self.transport.unverified
+        for i in range(self.MAX_REDIRECTS + 1):
+            started = time.time()
+            try:
+                response = await asyncio.wait_for(self.send(method, url, headers or {}, body, unverified),
+                                                  timeout)
+            except asyncio.TimeoutError:
+                get_report().add_request(url, time.time() - started, 0)
+                raise socket.timeout('Timed out: ' + url)
+            except Exception:
+                get_report().add_request(url, time.time() - started, 0)
+                raise
+            get_report().add_request(url, time.time() - started, len(response.body), response.status,
+                                     response.raw_size)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                if response.status not in (307, 308):
+                    method, body = 'GET', None
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status, response.reason, None, None)
+            return response
+        raise urllib.error.URLError('Too many redirects: ' + url)
+
+    async def send(self, method, url, headers, body, unverified):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        key = (parts.scheme, parts.hostname, parts.port, unverified)
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: ' + parts.netloc]
+        if not any(name.lower() == 'accept-encoding' for name in headers):
+            lines.append('Accept-Encoding: ' + Transport.ACCEPT_ENCODING)
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b'')
+        connection, reused = await self.acquire(key)
+        try:
+            response, keep_alive = await self.exchange(connection, request, method)
+        except (ConnectionError, EOFError) as e:
+            connection[1].close()
+            if not reused:
+                raise urllib.error.URLError(e)
+            # Server has closed idle keep-alive connection, try with a fresh one
+            connection, reused = await self.acquire(key, fresh=True)
+            try:
+                response, keep_alive = await self.exchange(connection, request, method)
+            except (ConnectionError, EOFError) as e:
+                connection[1].close()
+                raise urllib.error.URLError(e)
+            except BaseException:
+                connection[1].close()
+                raise
+        except BaseException:
+            connection[1].close()
+            raise
+        if keep_alive:
+            self.release(key, connection)
+        else:
+            connection[1].close()
+        return response
+
+    async def exchange(self, connection, request, method):
+        reader, writer = connection
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise EOFError('Connection closed')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        status = int(status)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = await self.read_chunked(reader)
+        elif 'content-length' in headers:
+            try:
+                body = await reader.readexactly(int(headers['content-length']))
+            except asyncio.IncompleteReadError as e:
+                raise urllib.error.ContentTooShortError(
+                    'Received %d bytes out of %s' % (len(e.partial), headers['content-length']), None)
+        else:
+            body = await reader.read()
+            keep_alive = False
+        raw_size = len(body)
+        encoding = headers.get('content-encoding', '').strip().lower()
+        if encoding in Decoder.ENCODINGS:
+            decoder = Decoder(encoding)
+            try:
+                body = decoder.decompress(body) + decoder.flush()
+            except zlib.error as e:
+                raise urllib.error.URLError(e)
+        return AsyncResponse(status, reason, headers, body, raw_size), keep_alive
+
+    @staticmethod
+    async def read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if not size:
+                # Skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+    async def acquire(self, key, fresh=False):
+        if not fresh:
+            connections = self.idle.get(key)
+            while connections:
+                connection = connections.pop()
+                if not connection[0].at_eof():
+                    return connection, True
+                connection[1].close()
+        scheme, host, port, unverified = key
+        if scheme == 'https':
+            connection = await asyncio.open_connection(host, port or 443,
+                                                       ssl=self.transport.get_context(unverified))
+        else:
+            connection = await asyncio.open_connection(host, port or 80)
+        return connection, False
+
+    def release(self, key, connection):
+        connections = self.idle.setdefault(key, [])
+        if len(connections) < self.MAX_IDLE_PER_HOST:
+            connections.append(connection)
+        else:
+            connection[1].close()
+
+    def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
+
+
+class AsyncEngine(object):
+    """
+    Event loop running in its own thread, shared by page and media downloads of the session
+    """
+    DEFAULT_CONCURRENCY = 100
+
+    def __init__(self, transport, retry_policy, concurrency=DEFAULT_CONCURRENCY):
+        self.transport = transport
+        self.retry_policy = retry_policy
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncHttpClient(transport)
+        # url: future of its download, every media url is downloaded once
+        # (see utils.MediaPlanner), used only in the loop's thread
+        self.media = {}
+        self.thread = threading.Thread(target=self.run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        # Closed: cancel the downloads left, so their futures are done and nobody waits for them
+        # asyncio.all_tasks() appeared in Python 3.7
+        all_tasks = asyncio.all_tasks if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks
+        tasks = [task for task in all_tasks(self.loop) if not task.done()]
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def submit(self, coroutine):
+        """
+        Run coroutine in the engine's loop from another thread
+        :return: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def call(self, url, request):
+        """
+        Await request() retrying it according to the retry policy of the session
+        """
+        policy = self.retry_policy
+        host = urllib.parse.urlsplit(url).netloc
+        attempt = 0
+        while True:
+            policy.check_circuit(host)
+            try:
+                result = await request()
+            except (urllib.error.URLError, socket.error) as e:
+                if not policy.is_retryable(e):
+                    if policy.is_answer(e):
+                        policy.close_circuit(host)
+                    raise
+                policy.record_failure(host)
+                if attempt >= policy.attempts or not policy.take_token():
+                    raise
+                await asyncio.sleep(policy.get_delay(attempt))
+                attempt += 1
+                continue
+            policy.record_success(host)
+            return result
+
+    async def get_content_new(self, lingualeo, url, more_values, retry=True):
+        """
+        The same as Lingualeo.get_content_new(), but doesn't block the loop
+        """
+        token = lingualeo.get_token()
+        values = {'apiVersion': '1.0.0', 'token': token}
+        values.update(more_values)
+        full_url = lingualeo.url_prefix + url
+        data = json.dumps(values).encode('utf-8')
+        headers = {'Content-Type': 'text/plain'}
+        cookie = get_cookie_header(lingualeo.cj, full_url)
+        if cookie:
+            headers['Cookie'] = cookie
+        try:
+            response = await self.call(full_url, lambda: self.client.request('POST', full_url, headers, data))
+            content = json.loads(response.body.decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            if e.code not in (401, 403):
+                raise
+            content = None
+        if content is None or is_auth_error(content):
+            if not retry:
+                raise lingualeo.session_rejected()
+            # Authorization uses the thread-based transport
+            await self.loop.run_in_executor(None, lingualeo.reauthorize, token)
+            return await self.get_content_new(lingualeo, url, more_values, False)
+        return content
+
+    async def download_media_file(self, url, cache=None):
+        future = self.media.get(url)
+        if future is None:
+            future = self.media[url] = asyncio.ensure_future(self.fetch_media_file(url, cache))
+        await asyncio.shield(future)
+
+    def forget_failed_media(self):
+        for url, future in list(self.media.items()):
+            if future.done() and (future.cancelled() or future.exception() is not None):
+                del self.media[url]
+
+    async def fetch_media_file(self, url, cache=None):
+        DOWNLOAD_TIMEOUT = 20
+        request = utils.get_media_request(url, cache)
+        if not request:
+            return
+        url, abs_path, headers = request
+        response = await self.call(url, lambda: self.client.request('GET', url, headers, None, DOWNLOAD_TIMEOUT,
+                                                                    unverified=True))
+        # File is written in a thread of the executor not to block other requests of the loop
+        await self.loop.run_in_executor(None, utils.save_media_response, response, url, abs_path, cache)
+
+    async def download_word(self, word, cache=None):
+        # the sound and the picture are downloaded at the same time
+        await asyncio.gather(*[self.download_media_file(url, cache) for url in utils.get_media_urls(word)])
+
+    def close(self):
+        """
+        Stop the loop and close keep-alive connections, unfinished requests are cancelled
+        """
+        def stop():
+            self.client.close()
+            self.loop.stop()
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(stop)
+
+
+class AsyncPageFetcher(PageFetcher):
+    """
+    PageFetcher which requests the pages in the engine's loop instead of worker threads
+    """
+    POLL_SECONDS = 0.1
+
+    def __init__(self, engine, lingualeo, url, values, workers=PageFetcher.DEFAULT_WORKERS, is_last=None):
+        """
+        :param values: values of the request, page number is added to them
+        """
+        PageFetcher.__init__(self, None, workers, is_last)
+        self.engine = engine
+        self.lingualeo = lingualeo
+        self.url = url
+        self.values = values
+
+    async def fetch_page_async(self, page):
+        content = await self.engine.get_content_new(self.lingualeo, self.url, dict(self.values, page=page))
+        return parse_words(content)
+
+    def start_workers(self, first, last):
+        self.engine.submit(self.run_async(first))
+
+    async def run_async(self, page):
+        pending = {}
+        while True:
+            with self.condition:
+                if self.closed or self.error:
+                    break
+                while len(pending) < self.workers and page <= self.last_page \
+                        and page < self.next_to_yield + self.window:
+                    pending[asyncio.ensure_future(self.fetch_page_async(page))] = page
+                    page += 1
+                if not pending and page > self.last_page:
+                    break
+            if not pending:
+                # Wait for the consumer to take some pages
+                await asyncio.sleep(self.POLL_SECONDS)
+                continue
+            done, _ = await asyncio.wait(list(pending), timeout=self.POLL_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                done_page = pending.pop(task)
+                if task.exception() is not None:
+                    self.store_error(task.exception())
+                else:
+                    self.store_result(done_page, task.result())
+        for task in pending:
+            task.cancel()
+
+
+class AsyncMediaDownloader(object):
+    """
+    The same as MediaDownloader, but media is downloaded by the engine's loop
+    with up to 'concurrency' words at the same time
+    """
+
+    def __init__(self, engine, cache=None, journal=None):
+        self.engine = engine
+        self.cache = cache
+        self.journal = journal
+        self.stopped = False
+        self.error = None
+
+    def download(self, words, idle=None):
+        """
+        Generator that yields tuples (word, error), see MediaDownloader.download()
+        """
+        results = queue.Queue()
+        self.error = None
+        self.engine.loop.call_soon_threadsafe(self.engine.forget_failed_media)
+        feeder = threading.Thread(target=self.feed, args=(words, results))
+        feeder.daemon = True
+        feeder.start()
+        while True:
+            try:
+                result = results.get(timeout=idle)
+            except queue.Empty:
+                yield None, None
+                continue
+            if result is None:
+                break
+            yield result
+        if self.error:
+            raise self.error
+
+    def feed(self, words, results):
+        concurrency = self.engine.concurrency
+        slots = threading.BoundedSemaphore(concurrency)
+        try:
+            for word in words:
+                if self.stopped:
+                    break
+                slots.acquire()
+                try:
+                    future = self.engine.submit(self.download_word(word))
+                except Exception:
+                    slots.release()
+                    raise
+                future.add_done_callback(lambda f, word=word: self.finish(f, word, results, slots))
+        except Exception as e:
+            self.error = e
+        finally:
+            # Waiters of a future are woken up before its callbacks are run,
+            # so the end is known only when finish() has released every slot
+            for _ in range(concurrency):
+                slots.acquire()
+            results.put(None)
+
+    def finish(self, future, word, results, slots):
+        try:
+            error = future.result()
+        except Exception as e:
+            # Unexpected error, show the word as a problem one
+            error = e
+        # Result is queued before the slot is released, see feed()
+        results.put((word, error))
+        slots.release()
+
+    async def download_word(self, word):
+        key = word.key
+        if self.journal and self.journal.is_media_finished(key):
+            return None
+        try:
+            with get_report().phase('media'):
+                await self.engine.download_word(word, self.cache)
+        except (urllib.error.URLError, socket.error) as e:
+            return e
+        if self.journal:
+            self.journal.media_finished(key)
+        return None
+
+    def stop(self):
+        self.stopped = True
+
+
+def get_cookie_header(cookiejar, url):
+    request = urllib.request.Request(url)
+    cookiejar.add_cookie_header(request)
+    return request.get_header('Cookie') or request.unredirected_hdrs.get('Cookie')
+
@@ -3,14 +3,26 @@ from .six.moves import http_cookiejar
 from .six.moves import urllib
 import socket
 import json
-import ssl
+import threading
+import time
+from .six.moves import queue
 
 from aqt.qt import *
 from . import utils
+from .journal import ProblemWords
+from .report import get_report
+from .retry import RetryPolicy
+from .transport import Transport
+from .word import Word
 
 
 class Lingualeo(QObject):
     Error = pyqtSignal(str)
+    # Session is considered expired a bit earlier than 'remember' cookie
+    SESSION_MARGIN = 60
+    # Validity of a session if 'remember' cookie has no expiration time
+    SESSION_TTL = 3600
+    SESSION_REJECTED_MSG = "LinguaLeo rejected the session after login. Please try again later"
 
     def __init__(self, email, password, cookies_path=None, parent=None):
         QObject.__init__(self, parent)
@@ -30,32 +42,59 @@ class Lingualeo(QObject):
                 except:
                     # TODO: Handle corrupt cookies loading
                     self.cj = http_cookiejar.MozillaCookieJar()
-        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cj))
+        self.transport = Transport(self.cj)
         config = utils.get_config()
+        self.retry_policy = RetryPolicy.from_config(config)
         self.url_prefix = 'https://'
         self.msg = ''
         self.tried_ssl_fix = False
+        self.auth_lock = threading.Lock()
+        self.page_sizes = PageSizes(max_size=int(utils.get_setting('maxWordsPerPage', PageSizes.MAX_SIZE)))
+        self.session_expires = self.get_session_expiry()
+        self.media_planner = utils.MediaPlanner()
+        self.async_engine = None
+
+    def get_async_engine(self):
+        """
+        Start asyncio network engine if it's enabled in config
+        :return: aio.AsyncEngine or None to use threads
+        """
+        if utils.get_setting('networkEngine', 'threads') != 'asyncio' or self.transport.proxies:
+            # Async engine connects directly, so proxies are supported by threads only
+            return None
+        if self.async_engine is None:
+            try:
+                from . import aio
+            except (ImportError, SyntaxError):
+                # Python 2 (Anki 2.0) has no asyncio
+                return None
+            concurrency = max(1, int(utils.get_setting('asyncConcurrency', aio.AsyncEngine.DEFAULT_CONCURRENCY)))
+            self.async_engine = aio.AsyncEngine(self.transport, self.retry_policy, concurrency)
+        return self.async_engine
+
+    def close(self):
+        """
+        Close keep-alive connections and stop the async engine of the session
+        """
+        if self.async_engine:
+            self.async_engine.close()
+            self.async_engine = None
+        self.transport.close()
 
     def get_connection(self):
+        """
+        Make sure there's a session to request content.
+        Saved session is trusted until 'remember' cookie expires,
+        if LinguaLeo rejects it, get_content_new() authorizes again
+        """
+        if self.session_expires and time.time() < self.session_expires:
+            return True
         try:
-            if not self.is_authorized():
-                status = self.auth()
-                if status['error_msg']:
-                    self.msg = status['error_msg']
+            status = self.auth()
+            if status['error_msg']:
+                self.msg = status['error_msg']
         except (urllib.error.URLError, socket.error) as e:
-            # TODO: Find better (secure) fix
-            """
-            SSLError was noticed on MacOS, because Python 3.6m used in Anki doesn't have 
-            security certificates downloaded. The easiest (but unsecure) way is to create SSL context.
-            """
-            if 'SSL' in str(e.args) and not self.tried_ssl_fix:
-                # Problem with https connection, trying ssl fix
-                # TODO: check if necessary to create empty cookies
-                # self.cj = http_cookiejar.MozillaCookieJar()
-
-                https_handler = urllib.request.HTTPSHandler(context=ssl._create_unverified_context())
-                self.opener = urllib.request.build_opener(https_handler, urllib.request.HTTPCookieProcessor(self.cj))
-                self.tried_ssl_fix = True
+            if self.try_ssl_fix(e):
                 return self.get_connection()
             else:
                 self.msg = "Can't authorize. Problems with internet connection. Error message: " + str(e.args)
@@ -79,6 +118,8 @@ class Lingualeo(QObject):
             return None
         try:
             url = 'mobile-api.lingualeo.com/GetWordSets'
+            # All dictionaries are requested at once, GetWordSets isn't known to support
+            # the page number, so the adaptive page size isn't used for it
             values = {'request': [{'type': 'user', 'perPage': 999, 'sortBy': 'created'}]}
             all_wordsets = self.get_content_new(url, values)['data'][0]['items']
             wordsets = []
@@ -89,12 +130,16 @@ class Lingualeo(QObject):
                 while others has attribute 'cw'
                 """
                 if 'cw' in wordset and wordset['cw'] != 0:
-                    wordsets.append(wordset.copy())
+                    wordsets.append(wordset)
                 elif 'countWords' in wordset and wordset['countWords'] != 0:
-                    wordsets.append(wordset.copy())
+                    wordsets.append(wordset)
             self.save_cookies()
             if not wordsets:
                 self.msg = 'No user dictionaries found'
+            else:
+                utils.set_cached_wordsets(self.email, wordsets)
+        except NotAuthorized:
+            return None
         except (urllib.error.URLError, socket.error):
             self.msg = "Can't get dictionaries. Problem with internet connection."
         except ValueError:
@@ -108,66 +153,142 @@ class Lingualeo(QObject):
             return None
         return wordsets
 
-    def get_words_to_add(self, status, wordsets=None):
-        if not self.get_connection():
-            return None
-        try:
-            words = self.get_words(status, wordsets)
-            self.save_cookies()
-        except (urllib.error.URLError, socket.error):
-            self.msg = "Can't download words. Problem with internet connection."
-        except ValueError:
-            self.msg = "Error! Possibly, invalid data was received from LinguaLeo"
-        except Exception as e:
-            self.msg = "There's been an unexpected error. Please copy the error message and create a new issue " \
-                       "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new). Error: " + str(e.args)
-        if self.msg:
-            self.Error.emit(self.msg)
-            self.msg = ''
-            return None
+    def iter_words(self, status, wordsets, since=None):
+        """
+        Generator that yields pages (lists) of words as soon as they are downloaded
+        either from main ('my') vocabulary or from user's dictionaries (wordsets).
+        Selected wordsets are requested in parallel, each one with its own number of pages,
+        and words repeated in several wordsets are returned once.
+        Estimated number of words and pages are stored in self.words_estimate and self.pages_estimate
+        after the first page is received, self.newest_word_time and self.word_wordsets
+        (dict word key: ids of the selected wordsets the word was received from,
+        None for the main dictionary) are set when all pages are received
+        :param status: progress status of the word: 'all', 'new', 'learning', learned'
+        :param wordsets: List of wordsets, or None to download all words (from main dictionary)
+        :param since: creation time of the newest word imported before,
+        words are requested from the newest to the oldest and only the newer words are returned
+        """
+        self.words_estimate = None
+        self.pages_estimate = None
+        self.newest_word_time = None
+        self.word_wordsets = None
+        self.estimate_lock = threading.Lock()
+
+        if wordsets:
+            streams = [self.iter_pages(status, wordset, None, len(wordsets)) for wordset in wordsets]
+            pages = streams[0] if len(streams) == 1 else merge_pages(streams)
+        else:
+            pages = self.iter_pages(status, None, since)
 
-        return words
+        # Words can repeat in several wordsets, only their keys are kept
+        seen = set()
+        # word key: [wordset ids], filled as the pages arrive, words may be already passed on
+        word_wordsets = {}
+        newest = 0
+        for wordset_id, page in pages:
+            words = []
+            for word in page:
+                key = word.key
+                if wordset_id is not None:
+                    ids = word_wordsets.setdefault(key, [])
+                    if wordset_id not in ids:
+                        ids.append(wordset_id)
+                if key in seen:
+                    continue
+                seen.add(key)
+                newest = max(newest, word.created)
+                # Words without creation time are always kept
+                if since is None or not 0 < word.created <= since:
+                    words.append(word)
+            if words:
+                yield words
+        self.newest_word_time = newest or None
+        self.word_wordsets = word_wordsets if wordsets else None
 
-    def get_words(self, status, wordsets):
+    def iter_pages(self, status, wordset=None, since=None, streams=1):
         """
-        Get words either from main ('my') vocabulary or from user's dictionaries (wordsets)
-        :param status: progress status of the word: 'all', 'new', 'learning', learned'
-        :param wordsets: List of wordset ids, or None to download all words (from main dictionary)
-        :return: list of words, where each word is a dict
+        Generator of the pages of the main dictionary or of one wordset in page order
+        :param wordset: wordset dict or None for the main dictionary
+        :param streams: number of wordsets requested at the same time, to share the workers
+        :return: tuples (wordset id or None, list of words)
         """
         url = 'mobile-api.lingualeo.com/GetWords'
-        # TODO: Move parameter to config?
-        PER_PAGE = 30
-        values = {'perPage': PER_PAGE, 'page': 1, 'status': status}
-        pages = 0
+        values = {'page': 1, 'status': status, 'sortBy': 'created'}
+        wordset_id = None
+        if wordset:
+            wordset_id = wordset['id']
+            values['wordSetIds'] = [wordset_id]
 
-        if wordsets:
-            wordset_ids = []
-            # Since words can repeat in the wordsets, we calculate upper bound
-            max_words = 0
-            for wordset in wordsets:
-                wordset_ids.append(wordset['id'])
-                max_words += wordset['cw'] if 'cw' in wordset else wordset['countWords']
-            values['wordSetIds'] = wordset_ids
-            pages = max_words // PER_PAGE + 1
-
-        response = self.get_content_new(url, values)
-        words = response['data']
-
-        if not wordsets:
-            # Calculate total number of pages since each response contains PER_PAGE words only
-            pages = response['wordSet']['countWords'] // PER_PAGE + 1
+        response, per_page = self.get_first_page(url, lambda size: dict(values, perPage=size),
+                                                 lambda content: content['data'])
+        # Raw words are converted to compact records as soon as a page is received
+        first_page = parse_words(response)
+
+        # Exact number of words is sent with the page, the count of the wordset is used if it isn't
+        exact_count = (response.get('wordSet') or {}).get('countWords')
+        words_count = exact_count
+        if words_count is None and wordset:
+            words_count = wordset['cw'] if 'cw' in wordset else wordset['countWords']
+        words_count = words_count or 0
+        if 0 < len(first_page) < min(per_page, words_count):
+            # LinguaLeo returned less words than requested, it may have a limit of page size,
+            # smaller pages are safe anyway: they are requested while they're full
+            per_page = len(first_page)
+            if exact_count is not None:
+                # Count of a wordset includes words of all statuses, so only the exact count
+                # of the requested words tells that the page was cut
+                self.page_sizes.capped(url, per_page)
+        values['perPage'] = per_page
+        # Calculate total number of pages since each response contains per_page words only
+        pages = words_count // per_page + 1
+        with self.estimate_lock:
+            self.words_estimate = (self.words_estimate or 0) + words_count
+            self.pages_estimate = (self.pages_estimate or 0) + pages
+
+        def reached_since(page_words):
+            # Words are sorted from newest, so there's nothing new after the word imported before
+            return since is not None and any(0 < word.created <= since for word in page_words)
 
         # Continue getting the words starting from the second page
-        for page in range(2, pages + 1):
-            values['page'] = page
-            next_chunk = self.get_content_new(url, values)['data']
-            if next_chunk:
-                words += next_chunk
-            else:
-                # Empty page, there are no more words
-                return words
-        return words
+        engine = self.get_async_engine()
+        if engine:
+            from .aio import AsyncPageFetcher
+            fetcher = AsyncPageFetcher(engine, self, url, values, max(1, engine.concurrency // streams),
+                                       reached_since)
+        else:
+            fetcher = PageFetcher(lambda page: parse_words(self.get_content_new(url, dict(values, page=page))),
+                                  max(1, self.get_page_workers() // streams), reached_since)
+        yield wordset_id, first_page
+        if first_page and not reached_since(first_page):
+            # Counts of the wordsets can be outdated (e.g. cached), so pages are requested while they're full
+            for page in fetcher.iter_full_pages(2, pages, per_page):
+                yield wordset_id, page
+
+    def get_first_page(self, url, make_values, get_items):
+        """
+        Request the first page using adaptive page size.
+        If LinguaLeo fails to send the page (HTTP error), smaller page is requested.
+        Invalid content doesn't depend on the page size, so it's raised at once
+        :param make_values: function that takes page size and returns values to send
+        :param get_items: function that takes response and returns the list of items
+        :return: tuple (response, page size)
+        """
+        per_page = self.page_sizes.get(url)
+        while True:
+            started = time.time()
+            try:
+                response = self.get_content_new(url, make_values(per_page))
+                get_items(response)
+            except urllib.error.HTTPError:
+                per_page = self.page_sizes.failed(url, per_page)
+                if per_page is None:
+                    raise
+                continue
+            self.page_sizes.succeeded(url, per_page, time.time() - started)
+            return response, per_page
+
+    def get_page_workers(self):
+        return max(1, int(utils.get_setting('pageWorkers', PageFetcher.DEFAULT_WORKERS)))
 
     def save_cookies(self):
         if hasattr(self, 'cookies_path'):
@@ -181,28 +302,95 @@ class Lingualeo(QObject):
                 self.token = cookie.value
                 return self.token
 
+    def get_session_expiry(self):
+        """
+        Returns time when the session kept by 'remember' cookie expires
+        or None if there's no session
+        """
+        for cookie in self.cj:
+            if cookie.name == 'remember':
+                if cookie.expires:
+                    return cookie.expires - self.SESSION_MARGIN
+                return time.time() + self.SESSION_TTL
+        return None
+
+    def try_ssl_fix(self, e):
+        """
+        SSLError was noticed on MacOS, because Python 3.6m used in Anki doesn't have
+        security certificates downloaded. The easiest (but unsecure) way is to create SSL context.
+        :return: True if the fix is applied and request should be repeated
+        """
+        # TODO: Find better (secure) fix
+        if 'SSL' in str(e.args) and not self.tried_ssl_fix:
+            # Problem with https connection, trying ssl fix
+            # TODO: check if necessary to create empty cookies
+            # self.cj = http_cookiejar.MozillaCookieJar()
+            self.transport.set_unverified(True)
+            self.tried_ssl_fix = True
+            return True
+        return False
+
+    def reauthorize(self, token):
+        """
+        Authorize again after LinguaLeo rejected the token.
+        Several threads can get rejected at once, but only the first one logs in
+        :param token: the token that was rejected
+        """
+        with self.auth_lock:
+            if self.get_token() != token:
+                # Somebody has already authorized
+                return
+            self.session_expires = None
+            status = self.auth()
+            if status['error_msg']:
+                self.Error.emit(status['error_msg'])
+                raise NotAuthorized()
+
+    def session_rejected(self):
+        """
+        Send the reason by Error when the request is rejected again after login
+        :return: NotAuthorized to raise
+        """
+        self.Error.emit(self.SESSION_REJECTED_MSG)
+        return NotAuthorized()
+
     # Low level methods
     #########################
 
-    def get_content_new(self, url, more_values):
+    def get_content_new(self, url, more_values, retry=True):
         """
-        A new API method to request content
+        A new API method to request content.
+        If the session is rejected, authorizes again and repeats the request once
         """
+        token = self.get_token()
         values = {'apiVersion': '1.0.0',
-                  'token': self.get_token()}
+                  'token': token}
         values.update(more_values)
         full_url = self.url_prefix + url
         json_data = json.dumps(values)
         data = json_data.encode('utf-8')
-        req = urllib.request.Request(full_url)
-        req.add_header('Content-Type', 'text/plain')
-        if self.tried_ssl_fix:
-            # Have to do it on MacOS for now
-            response = urllib.request.urlopen(req, data=data, context=ssl._create_unverified_context())
-        else:
-            # Default behavior
-            response = urllib.request.urlopen(req, data=data)
-        return json.loads(response.read())
+        headers = {'Content-Type': 'text/plain'}
+        def request():
+            # Connections (and unverified SSL context, if required on MacOS) are reused by transport
+            response = self.transport.open(full_url, data=data, headers=headers)
+            return json.loads(response.read().decode('utf-8'))
+
+        try:
+            content = self.retry_policy.call(full_url, request)
+        except urllib.error.HTTPError as e:
+            if e.code not in (401, 403):
+                raise
+            content = None
+        except (urllib.error.URLError, socket.error) as e:
+            if not retry or not self.try_ssl_fix(e):
+                raise
+            return self.get_content_new(url, more_values, False)
+        if content is None or is_auth_error(content):
+            if not retry:
+                raise self.session_rejected()
+            self.reauthorize(token)
+            return self.get_content_new(url, more_values, False)
+        return content
 
     """
     Using requests module (only in Anki 2.1) it can be performed as:
@@ -222,16 +410,17 @@ class Lingualeo(QObject):
     def auth(self):
         url = 'api.lingualeo.com/api/login'
         values = {'email': self.email, 'password': self.password}
-        content = self.get_content(url, values)
+        with get_report().phase('auth'):
+            content = self.get_content(url, values)
         self.save_cookies()
+        # New session has a new token
+        if hasattr(self, 'token'):
+            del self.token
         self.get_token()
+        if not content.get('error_msg'):
+            self.session_expires = self.get_session_expiry()
         return content
 
-    def is_authorized(self):
-        url = 'api.lingualeo.com/api/isauthorized'
-        status = self.get_content(url, None)['is_authorized']
-        return status
-
     def get_content(self, url, values):
         if values:
             url_values = urllib.parse.urlencode(values)
@@ -239,27 +428,197 @@ class Lingualeo(QObject):
         else:
             data = None
         full_url = self.url_prefix + url  # + '?' + url_values if url_values else self.url_prefix + url
-        req = self.opener.open(full_url, data=data)
-        return json.loads(req.read())
+        response = self.transport.open(full_url, data=data)
+        return json.loads(response.read().decode('utf-8'))
 
     # TODO: Add processing of http status codes in exceptions,
     #  see: http://docs.python-requests.org/en/master/user/quickstart/#response-status-codes
 
 
+class NotAuthorized(Exception):
+    """
+    Raised when connection to LinguaLeo failed, the reason is already sent by Lingualeo.Error
+    """
+
+
+class WordPages(object):
+    """
+    Pages of words to import. The words are requested only when
+    the object is iterated (in the download thread), starting with authorization check.
+    Keeps the number of pages received to show it to user
+    """
+
+    def __init__(self, lingualeo, status, wordsets=None, since=None):
+        self.lingualeo = lingualeo
+        self.status = status
+        self.wordsets = wordsets
+        self.since = since
+        self.received = 0
+        self.complete = False
+
+    def __iter__(self):
+        if not self.lingualeo.get_connection():
+            raise NotAuthorized()
+        pages = self.lingualeo.iter_words(self.status, self.wordsets, self.since)
+        while True:
+            # Time while the import waits for the next page
+            with get_report().phase('pages'):
+                page = next(pages, None)
+            if page is None:
+                break
+            self.received += 1
+            yield page
+        self.complete = True
+
+    @property
+    def words_estimate(self):
+        return getattr(self.lingualeo, 'words_estimate', None) if self.received else None
+
+    @property
+    def pages_estimate(self):
+        if self.complete:
+            return self.received
+        return getattr(self.lingualeo, 'pages_estimate', None) if self.received else None
+
+    @property
+    def newest_word_time(self):
+        return self.lingualeo.newest_word_time if self.complete else None
+
+    @property
+    def word_wordsets(self):
+        """
+        :return: dict word key: ids of the selected wordsets the word was received from,
+        None until all pages are received or if the main dictionary was requested
+        """
+        return self.lingualeo.word_wordsets if self.complete else None
+
+
+class WordsetsRefresh(QThread):
+    """
+    Requests wordsets in background while the cached ones are shown
+    """
+    Wordsets = pyqtSignal(list)
+
+    def __init__(self, lingualeo, parent=None):
+        QThread.__init__(self, parent)
+        self.lingualeo = lingualeo
+
+    def run(self):
+        # Errors are sent by Lingualeo.Error
+        wordsets = self.lingualeo.get_wordsets()
+        if wordsets:
+            self.Wordsets.emit(wordsets)
+
+
 class Download(QThread):
     Length = pyqtSignal(int)
     Counter = pyqtSignal(int)
     FinalCounter = pyqtSignal(int)
-    Word = pyqtSignal(dict)
+    # Pages of words received and estimated number of pages
+    Pages = pyqtSignal(int, int)
+    Words = pyqtSignal(list)
     Error = pyqtSignal(str)
+    # Send words to the main thread in batches, but don't keep them longer than a second
+    BATCH_SIZE = 50
+    BATCH_SECONDS = 1.0
 
-    def __init__(self, words, parent=None):
+    def __init__(self, pages, transport, retry_policy, media_cache=None, word_filter=None, journal=None,
+                 engine=None, planner=None, parent=None):
+        """
+        :param pages: iterable of lists of words. It can be WordPages,
+        then media is downloaded while the next pages are still being received
+        and estimated number of words and pages is taken from it
+        :param retry_policy: RetryPolicy of the session for media downloads
+        :param word_filter: function that returns False for the words that don't need to be imported
+        :param journal: ImportJournal to record downloaded media
+        :param engine: aio.AsyncEngine to download media with, threads are used if it's None
+        :param planner: utils.MediaPlanner of the session to download every media url once
+        """
         QThread.__init__(self, parent)
-        self.words = words
+        self.pages = pages
+        self.transport = transport
+        self.media_cache = media_cache
+        self.word_filter = word_filter
+        self.skipped = 0
+        self.length = 0
+        self.pages_progress = None
+        self.failed = []
+        self.succeeded = set()
+        if engine:
+            from .aio import AsyncMediaDownloader
+            self.downloader = AsyncMediaDownloader(engine, media_cache, journal)
+        else:
+            workers = utils.get_setting('downloadWorkers', MediaDownloader.DEFAULT_WORKERS)
+            self.downloader = MediaDownloader(transport, retry_policy, max(1, int(workers)), media_cache, journal,
+                                              planner)
 
     def run(self):
-        self.Length.emit(len(self.words))
-        self.add_separately()
+        # Show busy progress bar until the number of words is known
+        self.Length.emit(0)
+        msg = ''
+        try:
+            self.add_separately()
+        except NotAuthorized:
+            pass
+        except (urllib.error.URLError, socket.error):
+            msg = "Can't download words. Problem with internet connection."
+        except ValueError:
+            msg = "Error! Possibly, invalid data was received from LinguaLeo"
+        except Exception as e:
+            msg = "There's been an unexpected error. Please copy the error message and create a new issue " \
+                  "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new). Error: " + str(e.args)
+        if self.media_cache:
+            self.media_cache.save()
+        self.save_problem_words()
+        if msg:
+            self.Error.emit(msg)
+
+    def save_problem_words(self):
+        """
+        Keep failed words in user_files to retry them later,
+        and remove the words that were successfully imported this time
+        """
+        problems = ProblemWords.load()
+        if not problems and not self.failed:
+            return
+        problems.update(self.failed, self.succeeded)
+        problems.save()
+
+    def get_words(self):
+        """
+        Generator of words to import, consumed by media download workers
+        """
+        for page in self.pages:
+            if self.word_filter:
+                with get_report().phase('filter'):
+                    words = [word for word in page if self.word_filter(word)]
+                self.skipped += len(page) - len(words)
+                page = words
+            for word in page:
+                yield word
+
+    def update_progress(self, counter):
+        progress = counter + self.skipped
+        if isinstance(self.pages, list):
+            estimate = sum(len(page) for page in self.pages)
+        else:
+            estimate = getattr(self.pages, 'words_estimate', None)
+        length = max(estimate or 0, progress)
+        if estimate is not None and length != self.length:
+            self.length = length
+            self.Length.emit(length)
+        self.Counter.emit(progress)
+        self.update_pages_progress()
+
+    def update_pages_progress(self):
+        received = getattr(self.pages, 'received', None)
+        pages_estimate = getattr(self.pages, 'pages_estimate', None)
+        if received is None or pages_estimate is None:
+            return
+        pages_progress = (received, max(received, pages_estimate))
+        if pages_progress != self.pages_progress:
+            self.pages_progress = pages_progress
+            self.Pages.emit(*pages_progress)
 
     def add_separately(self):
         """
@@ -269,23 +628,41 @@ class Download(QThread):
         thread because it will freeze GUI
         """
         counter = 0
-        problem_words = []
+        batch = []
+        batch_started = time.time()
 
-        for word in self.words:
-            self.Word.emit(word)
-            try:
-                utils.send_to_download(word, self)
-            except (urllib.error.URLError, socket.error):
-                problem_words.append(word.get('wd'))
-            counter += 1
-            self.Counter.emit(counter)
+        # Media is downloaded by the pool of workers, while signals
+        # are sent from this thread only, so counter is always consistent
+        for word, error in self.downloader.download(self.get_words(), self.BATCH_SECONDS):
+            if word is not None:
+                batch.append(word)
+                if error:
+                    self.failed.append((word, error))
+                else:
+                    self.succeeded.add(ProblemWords.get_key(word))
+                counter += 1
+            if len(batch) >= self.BATCH_SIZE or time.time() - batch_started >= self.BATCH_SECONDS:
+                if batch:
+                    self.Words.emit(batch)
+                self.update_progress(counter)
+                batch = []
+                batch_started = time.time()
+        if batch:
+            self.Words.emit(batch)
+        self.update_pages_progress()
+        # Fill the progress bar, since estimated number of words can be bigger
+        self.Length.emit(counter + self.skipped)
+        self.Counter.emit(counter + self.skipped)
         self.FinalCounter.emit(counter)
 
-        # TODO: save problem words in json format to user_files folder
-        #  and ask user to retry downloading problem words
+        if self.failed:
+            self.problem_words_msg([word.wd for word, error in self.failed])
 
-        if problem_words:
-            self.problem_words_msg(problem_words)
+    def stop(self):
+        """
+        Ask media workers to finish, since they can't be terminated with the thread
+        """
+        self.downloader.stop()
 
     def problem_words_msg(self, problem_words):
         error_msg = ("We weren't able to download media for these "
@@ -293,5 +670,397 @@ class Download(QThread):
                      "or problems with an internet connection: ")
         for problem_word in problem_words[:-1]:
             error_msg += problem_word + ', '
-        error_msg += problem_words[-1] + '.'
+        error_msg += problem_words[-1] + '. '
+        error_msg += "Use 'Retry failed' button to download them again."
         self.Error.emit(error_msg)
+
+
+class MediaDownloader(object):
+    """
+    Downloads sounds and pictures of many words at the same time
+    using a pool of worker threads
+    """
+    DEFAULT_WORKERS = 8
+
+    def __init__(self, transport, retry_policy, workers=DEFAULT_WORKERS, cache=None, journal=None, planner=None):
+        """
+        :param transport: session's Transport to reuse connections
+        :param retry_policy: RetryPolicy to repeat failed downloads
+        :param workers: number of words downloaded at the same time
+        :param cache: utils.MediaCache to skip files that are already downloaded
+        :param journal: ImportJournal to skip media downloaded before the import was interrupted
+        :param planner: utils.MediaPlanner to download media shared by several words once
+        """
+        self.transport = transport
+        self.retry_policy = retry_policy
+        self.workers = workers
+        self.cache = cache
+        self.journal = journal
+        self.planner = planner
+        self.stopped = False
+        self.error = None
+
+    def download(self, words, idle=None):
+        """
+        Generator that downloads media of the words and yields tuples (word, error)
+        in the order downloads are finished. Error is None if media was downloaded.
+        Words are taken from the iterable only when workers are ready for them,
+        so it can be a generator that is still receiving words.
+        Exception raised by the iterable is raised here after running downloads are finished
+        :param idle: if given, (None, None) is yielded every idle seconds without finished downloads
+        """
+        tasks = queue.Queue(self.workers * 2)
+        results = queue.Queue()
+        self.error = None
+        if self.planner:
+            self.planner.forget_failed()
+        feeder = threading.Thread(target=self.feed, args=(words, tasks))
+        feeder.daemon = True
+        feeder.start()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, args=(tasks, results))
+            thread.daemon = True
+            thread.start()
+        finished = 0
+        while finished < self.workers:
+            try:
+                result = results.get(timeout=idle)
+            except queue.Empty:
+                yield None, None
+                continue
+            if result is None:
+                finished += 1
+            else:
+                yield result
+        if self.error:
+            raise self.error
+
+    def feed(self, words, tasks):
+        try:
+            for word in words:
+                if self.stopped:
+                    break
+                tasks.put(word)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Tell every worker that there are no more words
+            for i in range(self.workers):
+                tasks.put(None)
+
+    def work(self, tasks, results):
+        try:
+            word = tasks.get()
+            while word is not None:
+                if not self.stopped:
+                    results.put((word, self.download_word(word)))
+                word = tasks.get()
+        finally:
+            # Let the consumer know that the worker is done even if it has failed
+            results.put(None)
+
+    def download_word(self, word):
+        key = word.key
+        if self.journal and self.journal.is_media_finished(key):
+            return None
+        try:
+            with get_report().phase('media'):
+                utils.send_to_download(word, self.transport, self.retry_policy, self.cache, self.planner)
+        except (urllib.error.URLError, socket.error) as e:
+            return e
+        if self.journal:
+            self.journal.media_finished(key)
+        return None
+
+    def stop(self):
+        self.stopped = True
+
+
+class PageSizes(object):
+    """
+    Page sizes of LinguaLeo endpoints remembered in user_files.
+    If a page is received fast, next time the bigger one is tried,
+    if it was slow or failed, the smaller one is used.
+    Size which LinguaLeo failed to send isn't tried again until the ceiling expires
+    """
+    FILE_NAME = 'page_sizes.json'
+    MIN_SIZE = 30
+    DEFAULT_SIZE = 100
+    MAX_SIZE = 1000
+    FAST_SECONDS = 2
+    SLOW_SECONDS = 10
+    # Ceiling is forgotten after a week, LinguaLeo can raise its limits
+    CEILING_TTL = 7 * 24 * 3600
+    # Number of imports that got a short page of the same size to take it as the limit
+    CAP_EVIDENCE = 2
+
+    def __init__(self, defaults=None, max_size=MAX_SIZE):
+        """
+        :param defaults: dict with initial page sizes of endpoints that differ from DEFAULT_SIZE
+        :param max_size: maximum page size to try
+        """
+        self.defaults = defaults or {}
+        self.max_size = max(max_size, self.MIN_SIZE)
+        self.lock = threading.Lock()
+        self.sizes = utils.load_user_file(self.FILE_NAME, {})
+
+    def get(self, endpoint):
+        with self.lock:
+            entry = self.sizes.get(endpoint, {})
+            size = entry.get('size', self.defaults.get(endpoint, self.DEFAULT_SIZE))
+            return max(self.MIN_SIZE, min(size, self.get_limit(endpoint)))
+
+    def get_limit(self, endpoint):
+        entry = self.sizes.get(endpoint, {})
+        limit = max(self.max_size, self.defaults.get(endpoint, 0))
+        if self.has_ceiling(entry):
+            limit = min(limit, entry['ceiling'] - 1)
+        return limit
+
+    def has_ceiling(self, entry):
+        # Ceilings saved without time are outdated
+        return bool(entry.get('ceiling')) and time.time() - entry.get('time', 0) < self.CEILING_TTL
+
+    def set_ceiling(self, entry, ceiling):
+        if self.has_ceiling(entry):
+            ceiling = min(ceiling, entry['ceiling'])
+        entry['ceiling'] = ceiling
+        entry['time'] = time.time()
+
+    def failed(self, endpoint, size):
+        """
+        :return: smaller size to try or None if size is already the smallest
+        """
+        with self.lock:
+            if size <= self.MIN_SIZE:
+                return None
+            entry = self.sizes.setdefault(endpoint, {})
+            self.set_ceiling(entry, size)
+            entry['size'] = max(self.MIN_SIZE, size // 2)
+            self.save()
+            return entry['size']
+
+    def succeeded(self, endpoint, size, elapsed):
+        with self.lock:
+            if elapsed > self.SLOW_SECONDS:
+                next_size = size // 2
+            elif elapsed < self.FAST_SECONDS:
+                next_size = size * 2
+            else:
+                next_size = size
+            next_size = max(self.MIN_SIZE, min(next_size, self.get_limit(endpoint)))
+            entry = self.sizes.setdefault(endpoint, {})
+            if entry.get('size') != next_size:
+                entry['size'] = next_size
+                self.save()
+
+    def capped(self, endpoint, size):
+        """
+        LinguaLeo sent only size items while more were requested and available.
+        It's taken as the limit of the page size when it happens again with the same size
+        """
+        with self.lock:
+            entry = self.sizes.setdefault(endpoint, {})
+            # [size of the short page, number of times it was received]
+            capped = entry.get('capped')
+            count = capped[1] + 1 if capped and capped[0] == size else 1
+            if count >= self.CAP_EVIDENCE:
+                entry.pop('capped', None)
+                self.set_ceiling(entry, size + 1)
+                entry['size'] = min(entry.get('size', size), size)
+            else:
+                entry['capped'] = [size, count]
+            self.save()
+
+    def save(self):
+        utils.save_user_file(self.FILE_NAME, self.sizes)
+
+
+class PageFetcher(object):
+    """
+    Downloads numbered pages with a bounded pool of worker threads.
+    Pages are handed out in ascending order, so as soon as an empty page
+    is received, workers stop taking the pages that come after it.
+    Workers don't go further than a few pages ahead of the consumer
+    """
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, fetch_page, workers=DEFAULT_WORKERS, is_last=None):
+        """
+        :param fetch_page: function that takes a page number and returns a list of items
+        :param workers: maximum number of pages requested at the same time
+        :param is_last: optional function that takes items of a page
+        and returns True if no pages after it are needed
+        """
+        self.fetch_page = fetch_page
+        self.workers = workers
+        self.is_last = is_last
+        self.window = workers * 2
+        self.condition = threading.Condition()
+
+    def fetch(self, first, last):
+        """
+        Get pages from first to last (inclusive)
+        :return: list of non-empty pages in page order
+        """
+        return list(self.iter_pages(first, last))
+
+    def iter_pages(self, first, last):
+        """
+        Generator that yields non-empty pages from first to last (inclusive) in page order
+        """
+        if last < first:
+            return
+        self.next_page = first
+        self.next_to_yield = first
+        self.last_page = last
+        self.results = {}
+        self.error = None
+        self.closed = False
+        self.start_workers(first, last)
+        try:
+            while True:
+                with self.condition:
+                    while not self.error and self.next_to_yield <= self.last_page \
+                            and self.next_to_yield not in self.results:
+                        self.condition.wait()
+                    if self.error:
+                        raise self.error
+                    if self.next_to_yield > self.last_page:
+                        return
+                    items = self.results.pop(self.next_to_yield)
+                    self.next_to_yield += 1
+                    self.condition.notify_all()
+                yield items
+        finally:
+            # Consumer has stopped, workers shouldn't take new pages
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+
+    def iter_full_pages(self, first, last, page_size):
+        """
+        The same as iter_pages(), but if the last page is full, continues with the next pages
+        until there's a page with less than page_size items
+        """
+        while True:
+            items = None
+            for items in self.iter_pages(first, last):
+                yield items
+            if items is None or len(items) < page_size or self.last_page < last \
+                    or (self.is_last and self.is_last(items)):
+                return
+            first, last = last + 1, last + self.workers
+
+    def start_workers(self, first, last):
+        for i in range(min(self.workers, last - first + 1)):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def take_page(self):
+        with self.condition:
+            while not self.closed and self.next_page >= self.next_to_yield + self.window:
+                self.condition.wait()
+            if self.closed or self.error or self.next_page > self.last_page:
+                return None
+            page = self.next_page
+            self.next_page += 1
+            return page
+
+    def work(self):
+        page = self.take_page()
+        while page is not None:
+            try:
+                items = self.fetch_page(page)
+            except Exception as e:
+                self.store_error(e)
+                return
+            self.store_result(page, items)
+            page = self.take_page()
+
+    def store_result(self, page, items):
+        with self.condition:
+            if page <= self.last_page:
+                self.results[page] = items
+            if not items and page <= self.last_page:
+                # Empty page, there are no more words after it
+                self.last_page = page - 1
+            elif self.is_last and self.is_last(items) and page < self.last_page:
+                self.last_page = page
+            self.condition.notify_all()
+
+    def store_error(self, e):
+        with self.condition:
+            if not self.error:
+                self.error = e
+            self.condition.notify_all()
+
+
+def is_auth_error(content):
+    """
+    Check if LinguaLeo rejected the request because the session is not valid.
+    Besides HTTP status 401 or 403 (see get_content_new()), the mobile API can answer
+    with status 200 and an error object in the body: {"error": {"code": 401, ...}}.
+    Only these codes are taken as authorization errors, other errors are left to the caller
+    """
+    error = content.get('error') if isinstance(content, dict) else None
+    if not isinstance(error, dict):
+        return False
+    return str(error.get('code')) in ('401', '403')
+
+
+def merge_pages(streams):
+    """
+    Iterate several generators of pages at the same time, each one in its own thread
+    :return: generator of the items of all streams in the order they are received
+    """
+    items = queue.Queue(len(streams) * 2)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        # Don't block forever if the consumer has stopped
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed(stream):
+        error = None
+        try:
+            for item in stream:
+                if not put((item, None)):
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            stream.close()
+        put((done, error))
+
+    for stream in streams:
+        thread = threading.Thread(target=feed, args=(stream,))
+        thread.daemon = True
+        thread.start()
+    finished = 0
+    try:
+        while finished < len(streams):
+            item, error = items.get()
+            if error:
+                raise error
+            if item is done:
+                finished += 1
+            else:
+                yield item
+    finally:
+        stopped.set()
+
+
+def parse_words(content):
+    """
+    :return: list of Word records from GetWords response
+    """
+    return [Word.from_api(word) for word in content['data']]
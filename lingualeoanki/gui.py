@@ -1,6 +1,7 @@
 import locale
 import sys
 import platform as pm
+import time
 
 from aqt import mw
 from aqt.utils import showInfo
@@ -10,17 +11,26 @@ from . import connect
 from . import utils
 from . import styles
 from ._name import ADDON_NAME
+from .journal import ImportJournal, ProblemWords
+from .report import get_report, start_report
 
 
+# Number of added notes after which the collection is saved
+SAVE_EVERY = 500
+# Seconds during which cached wordsets are shown without refreshing them
+WORDSETS_CACHE_TTL = 3600
+
 # TODO: Make Russian localization
 #  (since beginners are more comfortable with native language)
 
-# TODO: Implement "Loading..." window to show user that list of words or list of dictionaries is being downloaded
+# TODO: Implement "Loading..." window to show user that list of dictionaries is being downloaded
 
 class PluginWindow(QDialog):
     def __init__(self, parent=None):
         QDialog.__init__(self, parent)
         self.config = utils.get_config()
+        # Media files of the downloads interrupted last time
+        utils.clean_partial_media()
         self.initUI()
 
     def initUI(self):
@@ -52,9 +62,11 @@ class PluginWindow(QDialog):
         # Import section widgets
         self.importAllButton = QPushButton("Import all words")
         self.importByDictionaryButton = QPushButton("Import from dictionaries")
+        self.retryButton = QPushButton("Retry failed")
         self.exitButton = QPushButton("Exit")
         self.importAllButton.clicked.connect(self.importAllButtonClicked)
         self.importByDictionaryButton.clicked.connect(self.wordsetButtonClicked)
+        self.retryButton.clicked.connect(self.retryButtonClicked)
         self.exitButton.clicked.connect(self.close)
         self.rbutton_all = QRadioButton("All")
         self.rbutton_new = QRadioButton("New")
@@ -62,6 +74,8 @@ class PluginWindow(QDialog):
         self.rbutton_learned = QRadioButton("Learned")
         self.rbutton_all.setChecked(True)
         self.checkBoxUpdateNotes = QCheckBox('Update existing notes')
+        self.checkBoxFullSync = QCheckBox('Full resync')
+        self.checkBoxFullSync.setToolTip('Download all words, not only the words added since the last import')
         self.progressLabel = QLabel('Downloading Progress:')
         self.progressBar = QProgressBar()
 
@@ -93,6 +107,7 @@ class PluginWindow(QDialog):
         options_layout.addWidget(self.rbutton_learned)
         options_layout.addSpacing(15)
         options_layout.addWidget(self.checkBoxUpdateNotes)
+        options_layout.addWidget(self.checkBoxFullSync)
         options_layout.addStretch()
         # Form layout for option buttons and progress bar
         progress_layout = QFormLayout()
@@ -103,6 +118,7 @@ class PluginWindow(QDialog):
         imp_btn_layout.addStretch()
         imp_btn_layout.addWidget(self.importAllButton)
         imp_btn_layout.addWidget(self.importByDictionaryButton)
+        imp_btn_layout.addWidget(self.retryButton)
         imp_btn_layout.addWidget(self.exitButton)
         imp_btn_layout.addStretch()
         # Main layout
@@ -173,6 +189,7 @@ class PluginWindow(QDialog):
         utils.clean_cookies()
         self.config['stayLoggedIn'] = False
         utils.update_config(self.config)
+        self.close_session()
 
         # Enable Login button and fields
         self.set_login_form_enabled(True)
@@ -187,16 +204,48 @@ class PluginWindow(QDialog):
     def wordsetButtonClicked(self):
         self.allow_to_close(False)
         self.set_download_form_enabled(False)
-        wordsets = self.lingualeo.get_wordsets()
+        # Cached wordsets are shown at once and refreshed in background if they're outdated
+        wordsets, saved = utils.get_cached_wordsets(self.lingualeo.email)
+        ttl = float(self.config.get('wordsetsCacheTTL', WORDSETS_CACHE_TTL))
+        outdated = bool(wordsets) and time.time() - saved > ttl
+        if not wordsets:
+            wordsets = self.lingualeo.get_wordsets()
         if wordsets:
             word_status = self.get_progress_status()
             wordset_window = WordsetsWindow(wordsets, word_status)
             wordset_window.Wordsets.connect(self.download_words)
             wordset_window.Cancel.connect(self.set_download_form_enabled)
+            if outdated and not self.is_refreshing_wordsets():
+                self.wordsets_refresh = connect.WordsetsRefresh(self.lingualeo)
+                self.wordsets_refresh.Wordsets.connect(wordset_window.update_wordsets)
+                self.wordsets_refresh.start()
             wordset_window.exec_()
         else:
             self.set_download_form_enabled(True)
 
+    def is_downloading(self):
+        return hasattr(self, 'threadclass') and self.threadclass.isRunning()
+
+    def is_refreshing_wordsets(self):
+        return hasattr(self, 'wordsets_refresh') and self.wordsets_refresh.isRunning()
+
+    def retryButtonClicked(self):
+        """
+        Download media and create notes only for the words that failed before
+        """
+        words = ProblemWords.load().get_words()
+        if not words:
+            self.update_retry_button()
+            return
+        self.allow_to_close(False)
+        self.set_download_form_enabled(False)
+        self.status = 'all'
+        self.sync_all = False
+        # Notes of the failed words are already created, but they need to be updated
+        self.journal = None
+        self.word_pages = None
+        self.start_download_thread([words], True)
+
     def reject(self):
         """
         Override reject event to handle Escape key press correctly
@@ -212,11 +261,16 @@ class PluginWindow(QDialog):
             answer = qm.question(self, '', "Are you sure you want to stop downloading?",
                                  qm.Yes | qm.Cancel, qm.Cancel)
             if answer == qm.Yes and not self.threadclass.isFinished():
+                self.threadclass.stop()
                 self.threadclass.terminate()
             elif answer == qm.Cancel:
                 event.ignore()
                 return
             # TODO: Don't close add-on window if the 'Stop' button was pressed
+        if self.is_refreshing_wordsets():
+            # Thread can't be destroyed while it's running
+            self.wordsets_refresh.wait()
+        self.close_session()
         # Delete attribute before closing to allow running the add-on again
         if hasattr(mw, ADDON_NAME):
             delattr(mw, ADDON_NAME)
@@ -226,9 +280,36 @@ class PluginWindow(QDialog):
         mw.reset()
 
     def downloadFinished(self):
+        self.lingualeo.save_cookies()
+        self.save_notes()
+        # Only after the notes are saved, otherwise unsaved updates would be skipped next time
+        with get_report().phase('save'):
+            self.fingerprints.save()
+        # Report is saved for interrupted imports too, to find out what was slow
+        report = get_report()
+        report.finish()
+        report.save()
         if hasattr(self, 'wordsFinalCount'):
-            showInfo("%d words from LinguaLeo have been processed" % self.wordsFinalCount)
+            # All words are processed and their notes are saved
+            self.save_watermark()
+            if self.journal:
+                # Import is complete, nothing to resume
+                self.journal.finish()
+            # Counts of learned words could change
+            utils.invalidate_cached_wordsets(self.lingualeo.email)
+            if self.wordsFinalCount:
+                showInfo("%d words from LinguaLeo have been processed\n\n%s" %
+                         (self.wordsFinalCount, report.get_summary()))
+            else:
+                progress = self.status
+                msg = 'No %s words to download' % progress if progress != 'all' else 'No words to download'
+                showInfo(msg)
             delattr(self, 'wordsFinalCount')
+            # Activate add-on window
+            addon_window = getattr(mw, ADDON_NAME, None)
+            if addon_window:
+                addon_window.activateWindow()
+                addon_window.raise_()
         self.set_download_form_enabled(True)
         self.logoutButton.setEnabled(True)
         self.progressLabel.hide()
@@ -243,6 +324,7 @@ class PluginWindow(QDialog):
         """
         Creates lingualeo object and connects to the website
         """
+        self.close_session()
         self.lingualeo = connect.Lingualeo(login, password, cookies_path)
         self.lingualeo.Error.connect(self.showErrorMessage)
         if self.lingualeo.get_connection():
@@ -252,43 +334,83 @@ class PluginWindow(QDialog):
             self.logoutButton.setEnabled(True)
             self.set_download_form_enabled(True)
 
+    def close_session(self):
+        """
+        Release connections and the network engine of the current session
+        """
+        if getattr(self, 'lingualeo', None):
+            self.lingualeo.close()
+
     def download_words(self, wordsets=None):
-        # TODO: Run it inside the other thread to handle big dictionaries
         self.allow_to_close(False)
         status = self.get_progress_status()
-        words = self.lingualeo.get_words_to_add(status, wordsets)
-        filtered = self.filter_words(words)
-        if filtered:
-            self.start_download_thread(filtered)
-        else:
-            progress = self.get_progress_status()
-            msg = 'No %s words to download' % progress if progress != 'all' else 'No words to download'
-            showInfo(msg)
-            self.allow_to_close(True)
-            self.set_download_form_enabled(True)
-            # TODO: Check if it is needed in other functions too
-            # Activate add-on window
-            addon_window = getattr(mw, ADDON_NAME, None)
-            if addon_window:
-                addon_window.activateWindow()
-                addon_window.raise_()
-
-    def filter_words(self, words):
+        update = bool(self.checkBoxUpdateNotes.checkState())
+        # Newer words are imported from the main dictionary only, since the status
+        # of older words can change, and all words are needed to update notes
+        since = None
+        if not wordsets and status == 'all' and not update and not self.checkBoxFullSync.checkState():
+            since = utils.get_watermark(self.lingualeo.email)
+        params = {'email': self.lingualeo.email, 'status': status,
+                  'wordsets': wordsets, 'update': update, 'since': since}
+        self.journal = self.get_journal(params)
+        if self.journal:
+            # Parameters of the interrupted import if it's resumed
+            params = self.journal.params
+        self.import_words(params)
+
+    def get_journal(self, params):
         """
-        Eliminates unnecessary to download words.
-        We have to do it in main thread to query database for duplicates
+        Offers to resume the interrupted import, otherwise starts a new journal
+        :return: ImportJournal or None if it can't be saved
         """
-        if not words:
+        journal = ImportJournal.load_unfinished()
+        if journal and journal.params.get('email') == params['email']:
+            qm = QMessageBox()
+            answer = qm.question(self, '', "Previous import was interrupted after %d words. "
+                                           "Do you want to resume it?" % journal.get_progress(),
+                                 qm.Yes | qm.No, qm.Yes)
+            if answer == qm.Yes:
+                return journal
+        if journal:
+            journal.discard()
+        return ImportJournal.start(params)
+
+    def import_words(self, params):
+        self.status = params['status']
+        self.sync_all = not params['wordsets'] and params['status'] == 'all'
+        # Authorization and pages of words are requested in the download thread,
+        # pages are filtered and imported while the next ones are being downloaded
+        self.word_pages = connect.WordPages(self.lingualeo, params['status'], params['wordsets'], params['since'])
+        self.start_download_thread(self.word_pages, params['update'])
+
+    def get_word_filter(self, update):
+        """
+        Returns a function to eliminate unnecessary to download words or None to download all words.
+        Duplicates index is built in main thread to query database,
+        while the filter is called in the download thread
+        """
+        # Index is also used to find notes to update and updated when the notes are added
+        with get_report().phase('index'):
+            self.duplicates = utils.DuplicateIndex(mw.col)
+            self.fingerprints = utils.NoteFingerprints(mw.col)
+        journal = self.journal
+        if update and not journal:
             return None
-        update = self.checkBoxUpdateNotes.checkState()
-        if not update:
+        duplicates = self.duplicates
+
+        def word_filter(word):
+            # Notes of resumed import are already saved
+            if journal and journal.is_note_written(word.key):
+                return False
             # Exclude duplicates, if full update is not required
-            words = [word for word in words if not utils.is_duplicate(word)]
-        return words
+            return update or word not in duplicates
+        return word_filter
 
-    def start_download_thread(self, words):
+    def start_download_thread(self, pages, update):
+        start_report()
         # Activate progress bar
         self.progressBar.setValue(0)
+        self.progressLabel.setText('Loading...')
         self.progressBar.show()
         self.progressLabel.show()
         self.logoutButton.setEnabled(False)
@@ -298,34 +420,73 @@ class PluginWindow(QDialog):
         self.set_model()
 
         # Start downloading
-        self.threadclass = connect.Download(words)
-        self.threadclass.start()
+        # Check if media of existing notes was changed only when notes are updated
+        media_cache = utils.MediaCache(revalidate=update)
+        self.threadclass = connect.Download(pages, self.lingualeo.transport, self.lingualeo.retry_policy,
+                                            media_cache, self.get_word_filter(update), self.journal,
+                                            self.lingualeo.get_async_engine(), self.lingualeo.media_planner)
         self.threadclass.Length.connect(self.progressBar.setMaximum)
-        self.threadclass.Word.connect(self.addWord)
+        self.threadclass.Pages.connect(self.showPagesProgress)
+        self.threadclass.Words.connect(self.addWords)
         self.threadclass.Counter.connect(self.progressBar.setValue)
         self.threadclass.FinalCounter.connect(self.setFinalCount)
         self.threadclass.Error.connect(self.showErrorMessage)
         self.threadclass.finished.connect(self.downloadFinished)
+        self.unsaved_notes = []
+        # Updates of existing notes are written in bulk when the notes are saved
+        self.updater = utils.NoteUpdater(mw.col, self.model, self.fingerprints)
+        self.threadclass.start()
 
     def set_model(self):
         self.model = utils.prepare_model(mw.col, utils.fields, styles.model_css)
 
-    def addWord(self, word):
+    def addWords(self, words):
         """
         Note is an SQLite object in Anki so you need
-        to fill it out inside the main thread
+        to fill it out inside the main thread.
+        Collection is saved every saveEvery notes,
+        so no more than that is lost if Anki crashes
         """
-        utils.add_word(word, self.model)
+        with get_report().phase('notes'):
+            for word in words:
+                utils.add_word(word, self.model, self.duplicates, self.fingerprints, self.updater)
+        self.unsaved_notes += [word.key for word in words]
+        if len(self.unsaved_notes) >= int(self.config.get('saveEvery', SAVE_EVERY)):
+            self.save_notes()
+
+    def save_notes(self):
+        with get_report().phase('save'):
+            self.updater.flush()
+            mw.col.save()
+        if self.journal:
+            self.journal.notes_written(self.unsaved_notes)
+        self.unsaved_notes = []
+
+    def showPagesProgress(self, received, total):
+        if received < total:
+            self.progressLabel.setText('Loading... (page %d of ~%d)' % (received, total))
+        else:
+            self.progressLabel.setText('Downloading Progress:')
 
     def setFinalCount(self, counter):
         self.wordsFinalCount = counter
 
+    def save_watermark(self):
+        if not self.sync_all:
+            return
+        newest = self.word_pages.newest_word_time
+        if newest:
+            previous = utils.get_watermark(self.lingualeo.email)
+            utils.set_watermark(self.lingualeo.email, max(newest, previous or 0))
+
 # UI helpers
 #####################################
 
     def showErrorMessage(self, msg):
         showInfo(msg)
-        mw.reset()
+        # Main window is reset once the download is finished
+        if not self.is_downloading():
+            mw.reset()
 
     def update_window(self):
         """
@@ -360,8 +521,19 @@ class PluginWindow(QDialog):
         self.rbutton_learning.setEnabled(mode)
         self.rbutton_learned.setEnabled(mode)
         self.checkBoxUpdateNotes.setEnabled(mode)
+        self.checkBoxFullSync.setEnabled(mode)
+        self.update_retry_button(mode)
         self.update_window()
 
+    def update_retry_button(self, mode=True):
+        """
+        Show number of failed words on the button, which is hidden if there are none
+        """
+        problems = len(ProblemWords.load())
+        self.retryButton.setText('Retry failed (%d)' % problems)
+        self.retryButton.setVisible(problems > 0)
+        self.retryButton.setEnabled(mode and problems > 0)
+
     def set_login_form_enabled(self, mode):
         """
         Set login elements either enabled or disabled
@@ -408,20 +580,7 @@ class WordsetsWindow(QDialog):
         self.listWidget = QListWidget()
         self.listWidget.setSelectionMode(QAbstractItemView.ExtendedSelection)
         for wordset in self.wordsets:
-            if 'countWords' in wordset:  # Main dictionary with all words
-                if self.word_status == 'learned':
-                    learned = wordset['countWordsLearned'] if 'countWordsLearned' in wordset else 0
-                    item_name = wordset['name'] + ' (' + str(learned) + ' learned words)'
-                else:  #
-                    item_name = wordset['name'] + ' (' + str(wordset['countWords']) + ' words in total)'
-            elif self.word_status == 'learned':  # for learned status in other user dictionaries
-                learned = wordset['cl'] if 'cl' in wordset else 0
-                item_name = wordset['name'] + ' (' + str(learned) + ' learned words)'
-            else:    # for other statuses (all, new, learning) of other user dictionaries
-                item_name = wordset['name'] + ' (' + str(wordset['cw']) + ' words in total)'
-            item = QListWidgetItem(item_name)
-            item.wordset_id = wordset['id']
-            self.listWidget.addItem(item)
+            self.add_item(wordset)
 
         # Horizontal layout for buttons
         hbox = QHBoxLayout()
@@ -439,6 +598,46 @@ class WordsetsWindow(QDialog):
         setattr(self, 'silentlyClose', 1)
         self.show()
 
+    def get_item_name(self, wordset):
+        if 'countWords' in wordset:  # Main dictionary with all words
+            if self.word_status == 'learned':
+                learned = wordset['countWordsLearned'] if 'countWordsLearned' in wordset else 0
+                item_name = wordset['name'] + ' (' + str(learned) + ' learned words)'
+            else:  #
+                item_name = wordset['name'] + ' (' + str(wordset['countWords']) + ' words in total)'
+        elif self.word_status == 'learned':  # for learned status in other user dictionaries
+            learned = wordset['cl'] if 'cl' in wordset else 0
+            item_name = wordset['name'] + ' (' + str(learned) + ' learned words)'
+        else:    # for other statuses (all, new, learning) of other user dictionaries
+            item_name = wordset['name'] + ' (' + str(wordset['cw']) + ' words in total)'
+        return item_name
+
+    def add_item(self, wordset):
+        item = QListWidgetItem(self.get_item_name(wordset))
+        item.wordset_id = wordset['id']
+        self.listWidget.addItem(item)
+
+    def update_wordsets(self, wordsets):
+        """
+        Show refreshed wordsets in place of the cached ones, keeping selection
+        """
+        ids = set(str(wordset['id']) for wordset in wordsets)
+        items = {}
+        for i in reversed(range(self.listWidget.count())):
+            item = self.listWidget.item(i)
+            if str(item.wordset_id) in ids:
+                items[str(item.wordset_id)] = item
+            else:
+                # Dictionary was deleted
+                self.listWidget.takeItem(i)
+        for wordset in wordsets:
+            item = items.get(str(wordset['id']))
+            if item:
+                item.setText(self.get_item_name(wordset))
+            else:
+                self.add_item(wordset)
+        self.wordsets = wordsets
+
     def importButtonClicked(self):
         items = self.listWidget.selectedItems()
         selected_ids = []
@@ -447,7 +646,7 @@ class WordsetsWindow(QDialog):
         selected_wordsets = []
         for wordset in self.wordsets:
             if str(wordset['id']) in selected_ids:
-                selected_wordsets.append(wordset.copy())
+                selected_wordsets.append(wordset)
         self.close()
         self.Wordsets.emit(selected_wordsets)
 
@@ -0,0 +1,179 @@
+"""
+Journal of the running import and the words that failed to import,
+both kept in the user_files folder.
+
+Every line of the journal is a json record: parameters of the import,
+words whose media is downloaded and words whose notes are saved
+in the collection. If Anki crashes or the download is stopped,
+the journal stays unfinished and the next import can resume it.
+"""
+
+import json
+import os
+import threading
+
+from . import utils
+from .word import Word
+
+
+class ImportJournal(object):
+    FILE_NAME = 'import_journal.jsonl'
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.params = {}
+        self.media = set()
+        self.notes = set()
+        self.finished = False
+
+    @classmethod
+    def start(cls, params):
+        """
+        Start a new journal, replacing the previous one
+        :param params: dict with parameters to repeat the import
+        :return: ImportJournal or None if it can't be saved
+        """
+        path = utils.get_user_files_path(cls.FILE_NAME)
+        if not path:
+            return None
+        journal = cls(path)
+        journal.params = params
+        try:
+            with open(path, 'w') as f:
+                f.write(json.dumps({'params': params}) + '\n')
+        except IOError:
+            return None
+        return journal
+
+    @classmethod
+    def load_unfinished(cls):
+        """
+        :return: ImportJournal of the interrupted import or None
+        """
+        path = utils.get_user_files_path(cls.FILE_NAME)
+        if not path or not os.path.exists(path):
+            return None
+        journal = cls(path)
+        line = '\n'
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line can be incomplete after crash
+                        continue
+                    journal.read_record(record)
+            if not line.endswith('\n'):
+                # Don't let the next record continue incomplete line
+                with open(path, 'a') as f:
+                    f.write('\n')
+        except IOError:
+            return None
+        if journal.finished or not journal.params:
+            return None
+        return journal
+
+    def read_record(self, record):
+        if 'params' in record:
+            self.params = record['params']
+        elif 'media' in record:
+            self.media.add(record['media'])
+        elif 'notes' in record:
+            self.notes.update(record['notes'])
+        elif 'finished' in record:
+            self.finished = True
+
+    def write(self, record):
+        with self.lock:
+            self.read_record(record)
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except IOError:
+                # Journal only helps to resume the import
+                pass
+
+    def media_finished(self, key):
+        self.write({'media': key})
+
+    def notes_written(self, keys):
+        """
+        Should be called after the notes are saved in the collection
+        """
+        if keys:
+            self.write({'notes': list(keys)})
+
+    def finish(self):
+        self.write({'finished': True})
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def is_media_finished(self, key):
+        return key in self.media
+
+    def is_note_written(self, key):
+        return key in self.notes
+
+    def get_progress(self):
+        return len(self.notes)
+
+
+class ProblemWords(object):
+    """
+    Words which media wasn't downloaded, with the reason,
+    saved to retry only them later
+    """
+    FILE_NAME = 'problem_words.json'
+
+    def __init__(self, entries=None):
+        # word key: {'word': word, 'error': error message}
+        self.entries = entries or {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        entries = utils.load_user_file(cls.FILE_NAME, [])
+        problems = cls()
+        for entry in entries:
+            if isinstance(entry, dict) and isinstance(entry.get('word'), dict):
+                # Words saved by older versions are raw GetWords dicts
+                word = Word.from_dict(entry['word'])
+                problems.entries[problems.get_key(word)] = {'word': word, 'error': entry.get('error')}
+        return problems
+
+    @staticmethod
+    def get_key(word):
+        return str(word.key)
+
+    def update(self, failed, succeeded):
+        """
+        :param failed: list of tuples (word, error)
+        :param succeeded: keys (see get_key()) of the words imported without problems
+        """
+        with self.lock:
+            for key in succeeded:
+                self.entries.pop(key, None)
+            for word, error in failed:
+                self.entries[self.get_key(word)] = {'word': word, 'error': str(error)}
+
+    def save(self):
+        with self.lock:
+            return utils.save_user_file(self.FILE_NAME, [{'word': entry['word'].to_dict(), 'error': entry['error']}
+                                                         for entry in self.entries.values()])
+
+    def get_words(self):
+        with self.lock:
+            return [entry['word'] for entry in self.entries.values()]
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,187 @@
+"""
+Timing of the import: wall time of its phases (authorization, pages of words,
+filtering, media, adding and saving notes) and statistics of network requests
+per host with latency percentiles and the slowest requests.
+
+The report of the running import is returned by get_report(), so the code
+on the hot path doesn't need to pass it around. When the import is finished,
+the summary is shown to user and the report is saved to user_files.
+"""
+
+import heapq
+import threading
+import time
+
+from .six.moves import urllib
+from . import utils
+
+
+class ImportReport(object):
+    FILE_NAME = 'import_report.json'
+    # Number of the slowest requests to keep
+    SLOWEST = 10
+    PHASE_NAMES = [('auth', 'authorization'), ('pages', 'pages'), ('index', 'duplicates'),
+                   ('filter', 'filter'), ('media', 'media'), ('notes', 'notes'), ('save', 'saving')]
+    # Phases running in several threads at once, their span is shown instead of summed time
+    PARALLEL = ('media',)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        # name: [seconds, count, time of the first start, time of the last end]
+        self.phases = {}
+        # host: {'latencies': [seconds], 'bytes': bytes of the bodies,
+        #        'raw_bytes': bytes received (compressed), 'errors': failed requests}
+        self.hosts = {}
+        # heap of tuples (seconds, url, status) of the slowest requests
+        self.slowest = []
+
+    def phase(self, name):
+        """
+        Context manager to add the time of the block to the phase.
+        Time of the phases running in several threads is summed
+        """
+        return Phase(self, name)
+
+    def add_time(self, name, seconds, count=1):
+        now = time.time()
+        with self.lock:
+            phase = self.phases.setdefault(name, [0.0, 0, now - seconds, now])
+            phase[0] += seconds
+            phase[1] += count
+            phase[2] = min(phase[2], now - seconds)
+            phase[3] = now
+
+    def add_request(self, url, seconds, size, status=None, raw_size=None):
+        """
+        :param size: number of bytes of the body (after decompression)
+        :param status: HTTP status code or None if there's no response
+        :param raw_size: number of bytes received if the body was compressed
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            stats = self.hosts.setdefault(host, {'latencies': [], 'bytes': 0, 'raw_bytes': 0, 'errors': 0})
+            stats['latencies'].append(seconds)
+            stats['bytes'] += size
+            stats['raw_bytes'] += size if raw_size is None else raw_size
+            if status is None or status >= 400:
+                stats['errors'] += 1
+            # Status 0 if there's no response, to compare tuples in Python 3
+            item = (seconds, url, status or 0)
+            if len(self.slowest) < self.SLOWEST:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def finish(self):
+        self.finished = time.time()
+
+    def get_elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def get_requests(self):
+        """
+        :return: dict with statistics of the requests to all hosts
+        """
+        latencies = []
+        total = {'count': 0, 'bytes': 0, 'raw_bytes': 0, 'errors': 0}
+        for stats in self.hosts.values():
+            latencies += stats['latencies']
+            total['bytes'] += stats['bytes']
+            total['raw_bytes'] += stats['raw_bytes']
+            total['errors'] += stats['errors']
+        total.update(get_latency_stats(latencies))
+        return total
+
+    def to_dict(self):
+        with self.lock:
+            hosts = {}
+            for host, stats in self.hosts.items():
+                hosts[host] = {'bytes': stats['bytes'], 'raw_bytes': stats['raw_bytes'], 'errors': stats['errors']}
+                hosts[host].update(get_latency_stats(stats['latencies']))
+            return {'started': self.started,
+                    'seconds': round(self.get_elapsed(), 3),
+                    'phases': dict((name, {'seconds': round(seconds, 3), 'count': count,
+                                           'span': round(last - first, 3)})
+                                   for name, (seconds, count, first, last) in self.phases.items()),
+                    'requests': self.get_requests(),
+                    'hosts': hosts,
+                    'slowest': [{'url': url, 'seconds': round(seconds, 3), 'status': status or None}
+                                for seconds, url, status in sorted(self.slowest, reverse=True)]}
+
+    def get_summary(self):
+        """
+        Short text to show to user when the import is finished
+        """
+        with self.lock:
+            phases = []
+            for name, title in self.PHASE_NAMES:
+                if name in self.phases:
+                    seconds, count, first, last = self.phases[name]
+                    phases.append('%s %.1f s' % (title, last - first if name in self.PARALLEL else seconds))
+            requests = self.get_requests()
+        summary = 'Time: %.1f s' % self.get_elapsed()
+        if phases:
+            summary += ' (' + ', '.join(phases) + ')'
+        if requests['count']:
+            summary += '\nRequests: %d' % requests['count']
+            if requests['errors']:
+                summary += ' (%d failed)' % requests['errors']
+            summary += ', %.1f MB' % (requests['bytes'] / 1048576.0)
+            if requests['raw_bytes'] < requests['bytes']:
+                summary += ' (%.1f MB compressed)' % (requests['raw_bytes'] / 1048576.0)
+            summary += ', median %d ms, 90%% %d ms' % (requests['p50'] * 1000, requests['p90'] * 1000)
+        return summary
+
+    def save(self):
+        return utils.save_user_file(self.FILE_NAME, self.to_dict())
+
+
+class Phase(object):
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.report.add_time(self.name, time.time() - self.started)
+        return False
+
+
+def get_latency_stats(latencies):
+    """
+    :return: dict with number of requests, latency percentiles and maximum (seconds)
+    """
+    latencies = sorted(latencies)
+    stats = {'count': len(latencies)}
+    for name, percentile in (('p50', 50), ('p90', 90), ('p99', 99)):
+        # Nearest-rank percentile
+        index = max(0, -(-len(latencies) * percentile // 100) - 1)
+        stats[name] = round(latencies[index], 3) if latencies else 0
+    stats['max'] = round(latencies[-1], 3) if latencies else 0
+    return stats
+
+
+_report = ImportReport()
+
+
+def start_report():
+    """
+    Start the report of a new import
+    :return: ImportReport
+    """
+    global _report
+    _report = ImportReport()
+    return _report
+
+
+def get_report():
+    """
+    :return: ImportReport of the running (or the last) import
+    """
+    return _report
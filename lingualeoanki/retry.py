@@ -0,0 +1,151 @@
+"""
+Retry policy shared by API requests and media downloads.
+
+Failed requests are repeated with exponential backoff and random jitter,
+while the retry budget doesn't let retries multiply when everything fails.
+Circuit breaker counts consecutive failures of every host and, once the host
+looks down, fails fast instead of waiting for its timeouts again and again.
+"""
+
+import random
+import socket
+import threading
+import time
+
+from .six.moves import urllib
+
+
+class CircuitOpenError(urllib.error.URLError):
+    """
+    Raised without sending a request when the host failed too many times in a row.
+    It is an URLError to be handled as any other connection problem
+    """
+
+    def __init__(self, host):
+        urllib.error.URLError.__init__(self, 'Too many errors from %s, try again later' % host)
+        self.host = host
+
+
+class RetryPolicy(object):
+    DEFAULTS = {'retryAttempts': 3,
+                'retryDelay': 1.0,
+                'retryMaxDelay': 30.0,
+                'retryBudget': 20,
+                'breakerThreshold': 5,
+                'breakerCooldown': 60}
+    # Part of a retry token returned by every successful request
+    BUDGET_REFILL = 0.1
+
+    def __init__(self, attempts=3, delay=1.0, max_delay=30.0, budget=20,
+                 breaker_threshold=5, breaker_cooldown=60, sleep=time.sleep):
+        """
+        :param attempts: number of retries after the first failed attempt
+        :param delay: delay before the first retry (seconds), doubled for every next retry
+        :param max_delay: maximum delay between retries
+        :param budget: maximum number of retry tokens, every retry takes one token
+        :param breaker_threshold: number of consecutive failures to stop sending requests to the host
+        :param breaker_cooldown: seconds to wait before trying the host again
+        """
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.tokens = float(budget)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        # host: [consecutive failures, time when the circuit was opened or None]
+        self.hosts = {}
+
+    @classmethod
+    def from_config(cls, config):
+        settings = dict(cls.DEFAULTS)
+        settings.update((key, value) for key, value in (config or {}).items() if key in cls.DEFAULTS)
+        return cls(int(settings['retryAttempts']), float(settings['retryDelay']),
+                   float(settings['retryMaxDelay']), int(settings['retryBudget']),
+                   int(settings['breakerThreshold']), float(settings['breakerCooldown']))
+
+    def call(self, url, func):
+        """
+        Call func (which sends a request to url) and retry it if it failed
+        because of connection problems or server errors
+        :return: result of func
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        attempt = 0
+        while True:
+            self.check_circuit(host)
+            try:
+                result = func()
+            except (urllib.error.URLError, socket.error) as e:
+                if not self.is_retryable(e):
+                    if self.is_answer(e):
+                        self.close_circuit(host)
+                    raise
+                self.record_failure(host)
+                if attempt >= self.attempts or not self.take_token():
+                    raise
+                self.sleep(self.get_delay(attempt))
+                attempt += 1
+                continue
+            self.record_success(host)
+            return result
+
+    @staticmethod
+    def is_retryable(e):
+        """
+        Client errors (like broken link) won't disappear with retry,
+        except for timeout and 'too many requests'
+        """
+        if isinstance(e, CircuitOpenError):
+            return False
+        if isinstance(e, urllib.error.HTTPError):
+            return e.code >= 500 or e.code in (408, 429)
+        return True
+
+    @classmethod
+    def is_answer(cls, e):
+        """
+        Client error (like 404 of a broken link) is an answer of the host,
+        so for the circuit breaker the host is up
+        """
+        return isinstance(e, urllib.error.HTTPError) and not cls.is_retryable(e)
+
+    def get_delay(self, attempt):
+        # Full jitter: random delay up to exponentially growing limit
+        return random.uniform(0, min(self.max_delay, self.delay * 2 ** attempt))
+
+    def take_token(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def check_circuit(self, host):
+        with self.lock:
+            failures, opened = self.hosts.get(host, (0, None))
+            if opened is None:
+                return
+            if time.time() - opened < self.breaker_cooldown:
+                raise CircuitOpenError(host)
+            # Let one request try the host, others fail fast until it succeeds
+            self.hosts[host] = (failures, time.time())
+
+    def record_failure(self, host):
+        with self.lock:
+            failures, opened = self.hosts.get(host, (0, None))
+            failures += 1
+            if failures >= self.breaker_threshold:
+                opened = time.time()
+            self.hosts[host] = (failures, opened)
+
+    def close_circuit(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def record_success(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+            self.tokens = min(self.budget, self.tokens + self.BUDGET_REFILL)
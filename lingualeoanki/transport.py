@@ -0,0 +1,302 @@
+"""
+Keep-alive HTTP(S) transport shared by all requests of a LinguaLeo session.
+
+urllib opens a new connection (and makes a new TLS handshake) for every
+request, which is the most expensive part of importing thousands of words.
+Transport keeps idle connections per host and reuses them, creates SSL contexts
+only once and attaches the session's cookie jar to every request.
+JSON responses are very repetitive, so they are requested compressed
+(gzip or deflate) and decompressed incrementally while they are read.
+"""
+
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+from .six.moves import http_client
+from .six.moves import urllib
+from .report import get_report
+
+
+class Response(object):
+    """
+    A response of the Transport. The connection returns to the pool
+    when the body is read completely or the response is closed
+    """
+
+    def __init__(self, transport, key, conn, resp, url, started=None):
+        """
+        :param started: time when the request was sent, to report its latency
+        """
+        self.transport = transport
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.msg
+        self.started = started or time.time()
+        # Bytes after decompression and bytes received
+        self.size = 0
+        self.raw_size = 0
+        encoding = (self.headers.get('Content-Encoding') or '').strip().lower()
+        self.decoder = Decoder(encoding) if encoding in Decoder.ENCODINGS else None
+
+    def info(self):
+        # Used by cookie jar to extract cookies
+        return self.headers
+
+    def getheader(self, name, default=None):
+        value = self.headers.get(name)
+        return default if value is None else value
+
+    def read(self, amt=None):
+        if self.resp is None:
+            return b''
+        try:
+            data = self.read_decoded(amt)
+        except (http_client.HTTPException, zlib.error) as e:
+            # Connection was broken in the middle of the body (IncompleteRead)
+            # or compressed body is corrupt, handle it as any other connection problem
+            self.close()
+            raise urllib.error.URLError(e)
+        self.size += len(data)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def read_decoded(self, amt):
+        while True:
+            raw = self.resp.read() if amt is None else self.resp.read(amt)
+            self.raw_size += len(raw)
+            if self.decoder is None:
+                return raw
+            if amt is None:
+                return self.decoder.decompress(raw) + self.decoder.flush()
+            data = self.decoder.decompress(raw) if raw else self.decoder.flush()
+            # Compressed chunk can give no data yet, empty result means the end of the body
+            if data or not raw:
+                return data
+
+    def close(self):
+        if self.resp is None:
+            return
+        get_report().add_request(self.url, time.time() - self.started, self.size, self.status, self.raw_size)
+        finished = self.resp.isclosed()
+        if finished and not self.resp.will_close:
+            self.transport.release(self.key, self.conn)
+        else:
+            self.resp.close()
+            self.conn.close()
+        self.resp = None
+        self.conn = None
+
+
+class Transport(object):
+    MAX_IDLE_PER_HOST = 8
+    MAX_REDIRECTS = 5
+
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+    def __init__(self, cookiejar=None, unverified=False):
+        """
+        :param cookiejar: cookie jar to keep session cookies in
+        :param unverified: don't verify SSL certificates for API requests
+        """
+        self.cookiejar = cookiejar
+        self.unverified = unverified
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.contexts = {}
+        self.proxies = urllib.request.getproxies()
+
+    def set_unverified(self, unverified):
+        """
+        Switch API requests to (un)verified SSL connections
+        """
+        if unverified != self.unverified:
+            self.unverified = unverified
+            self.close()
+
+    def get_context(self, unverified):
+        with self.lock:
+            if unverified not in self.contexts:
+                if unverified:
+                    # TODO: find a better way for unsecure connection
+                    self.contexts[unverified] = ssl._create_unverified_context()
+                else:
+                    self.contexts[unverified] = ssl.create_default_context()
+            return self.contexts[unverified]
+
+    def open(self, url, data=None, headers=None, timeout=None, unverified=None):
+        """
+        Send request (POST if data is given, GET otherwise) and return Response.
+        Raises urllib.error.HTTPError for 4xx and 5xx status codes
+        to be handled the same way as with urllib
+        :param unverified: None to use the session's setting
+        """
+        if unverified is None:
+            unverified = self.unverified
+        for i in range(self.MAX_REDIRECTS + 1):
+            response = self.send(url, data, headers or {}, timeout, unverified)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                url = urllib.parse.urljoin(url, location)
+                if response.status not in (307, 308):
+                    data = None
+                continue
+            if response.status >= 400:
+                body = response.read()
+                raise urllib.error.HTTPError(url, response.status, response.reason,
+                                             response.info(), _BodyReader(body))
+            return response
+        raise urllib.error.URLError('Too many redirects: ' + url)
+
+    def send(self, url, data, headers, timeout, unverified):
+        req = urllib.request.Request(url, data=data, headers=headers)
+        if data is not None and not req.has_header('Content-type'):
+            req.add_header('Content-type', 'application/x-www-form-urlencoded')
+        if not req.has_header('Accept-encoding'):
+            # Responses are decompressed by Response.read()
+            req.add_header('Accept-encoding', self.ACCEPT_ENCODING)
+        if self.cookiejar is not None:
+            self.cookiejar.add_cookie_header(req)
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        key = (parts.scheme, parts.netloc, unverified)
+        started = time.time()
+        conn, reused = self.acquire(key, timeout)
+        if parts.scheme == 'http' and 'http' in self.proxies:
+            # Plain http proxy expects an absolute url
+            path = url
+        try:
+            resp = self.request(conn, req, path, data)
+        except (http_client.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                get_report().add_request(url, time.time() - started, 0)
+                raise
+            # Server has closed idle keep-alive connection, try with a fresh one
+            conn, reused = self.acquire(key, timeout, fresh=True)
+            try:
+                resp = self.request(conn, req, path, data)
+            except Exception:
+                conn.close()
+                get_report().add_request(url, time.time() - started, 0)
+                raise
+        response = Response(self, key, conn, resp, url, started)
+        if self.cookiejar is not None:
+            self.cookiejar.extract_cookies(response, req)
+        return response
+
+    @staticmethod
+    def request(conn, req, path, data):
+        conn.putrequest(req.get_method(), path, skip_accept_encoding=True)
+        for name, value in req.header_items():
+            conn.putheader(name, value)
+        if data is not None:
+            conn.putheader('Content-Length', str(len(data)))
+        conn.endheaders()
+        if data is not None:
+            conn.send(data)
+        return conn.getresponse()
+
+    def acquire(self, key, timeout, fresh=False):
+        """
+        Get idle connection to the host or create a new one
+        :return: tuple (connection, True if the connection was used before)
+        """
+        if not fresh:
+            with self.lock:
+                connections = self.idle.get(key)
+                conn = connections.pop() if connections else None
+            if conn is not None:
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self.connect(key, timeout), False
+
+    def connect(self, key, timeout):
+        scheme, netloc, unverified = key
+        kwargs = {} if timeout is None else {'timeout': timeout}
+        proxy = self.proxies.get(scheme)
+        host = netloc
+        if proxy:
+            host = urllib.parse.urlsplit(proxy).netloc
+        if scheme == 'https':
+            conn = http_client.HTTPSConnection(host, context=self.get_context(unverified), **kwargs)
+            if proxy:
+                conn.set_tunnel(netloc)
+        else:
+            conn = http_client.HTTPConnection(host, **kwargs)
+        return conn
+
+    def release(self, key, conn):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.MAX_IDLE_PER_HOST:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+class Decoder(object):
+    """
+    Incremental decompressor of gzip or deflate encoded body
+    """
+    ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'deflate':
+            self.obj = zlib.decompressobj()
+        else:
+            # Expect gzip header and trailer
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.started = False
+
+    def decompress(self, data):
+        if not self.started and data and self.encoding == 'deflate':
+            self.started = True
+            try:
+                return self.obj.decompress(data)
+            except zlib.error:
+                # Some servers send raw deflate stream without zlib header
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.obj.decompress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class _BodyReader(object):
+    """
+    File-like object with the body of unsuccessful response for HTTPError
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, amt=None):
+        data, self.body = (self.body, b'') if amt is None else (self.body[:amt], self.body[amt:])
+        return data
+
+    def close(self):
+        pass
@@ -1,16 +1,22 @@
 import os
 from random import randint
+import hashlib
 import json
 from .six.moves import urllib
-import socket
-import ssl
+import errno
+import threading
+import time
 
 from aqt import mw
 from anki import notes
+from anki.utils import ids2str, intTime, joinFields, splitFields, stripHTMLMedia
 
 from . import styles
 
 
+# Suffix of media files which are being downloaded
+PARTIAL_SUFFIX = '.lingualeo-part'
+
 fields = ['en', 'transcription',
           'ru', 'picture_name',
           'sound_name', 'context']
@@ -82,84 +88,293 @@ def get_valid_name(orig_name):
         return orig_name
 
 
-def download_media_file(url):
-    DOWNLOAD_TIMEOUT = 20
+class MediaCache(object):
+    """
+    Remembers ETag and Last-Modified headers of downloaded media files
+    (saved in the user_files folder) to ask LinguaLeo to send
+    the file only if it was changed since the last download
+    """
+
+    def __init__(self, revalidate=False, path=None):
+        """
+        :param revalidate: check if existing files were changed,
+        otherwise files that are already in the collection are not requested at all
+        :param path: json file to keep headers in, default is user_files/media_cache.json
+        """
+        self.revalidate = revalidate
+        self.path = path or get_user_files_path('media_cache.json')
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = False
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.loads(f.read())
+            except (IOError, ValueError):
+                # Corrupt cache, start from scratch
+                self.entries = {}
+
+    def get(self, url):
+        with self.lock:
+            return self.entries.get(url)
+
+    def set(self, url, etag, last_modified):
+        with self.lock:
+            if etag or last_modified:
+                self.entries[url] = {'etag': etag, 'modified': last_modified}
+            else:
+                self.entries.pop(url, None)
+            self.changed = True
+
+    def get_headers(self, url):
+        """
+        Headers for a conditional request, or None if file shouldn't be requested
+        """
+        if not self.revalidate:
+            return None
+        entry = self.get(url)
+        if not entry:
+            return None
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('modified'):
+            headers['If-Modified-Since'] = entry['modified']
+        return headers
+
+    def save(self):
+        with self.lock:
+            if not self.path or not self.changed:
+                return
+            try:
+                with open(self.path, 'w') as f:
+                    json.dump(self.entries, f)
+                self.changed = False
+            except IOError:
+                # Cache is only an optimization, files will be downloaded next time
+                pass
+
+
+class MediaPlanner(object):
+    """
+    Downloads every media url only once, although many words share pictures and sounds.
+    A word that needs the url which is being downloaded waits for that download
+    instead of requesting it again. Downloaded urls are remembered for the next
+    imports of the session, failed ones are forgotten to be requested again
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # url: PlannedDownload
+        self.downloads = {}
+        # Number of requests saved by sharing the downloads
+        self.shared = 0
+
+    def download(self, url, func):
+        """
+        Call func to download url, unless it was downloaded or is being downloaded.
+        Raises the error of the download if it failed
+        """
+        with self.lock:
+            planned = self.downloads.get(url)
+            if planned is None:
+                planned = self.downloads[url] = PlannedDownload()
+                is_owner = True
+            else:
+                self.shared += 1
+                is_owner = False
+        if not is_owner:
+            planned.wait()
+            return
+        try:
+            func()
+        except Exception as e:
+            planned.error = e
+            raise
+        finally:
+            planned.finished.set()
+
+    def forget_failed(self):
+        """
+        Should be called before a new import to try failed urls again
+        """
+        with self.lock:
+            for url, planned in list(self.downloads.items()):
+                if planned.error is not None:
+                    del self.downloads[url]
+
+
+class PlannedDownload(object):
+    def __init__(self):
+        self.finished = threading.Event()
+        self.error = None
+
+    def wait(self):
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+
+
+def get_media_request(url, cache=None):
+    """
+    Find where to save media file and check if it needs to be downloaded
+    :return: tuple (url, path to save, headers to send)
+    or None if the file is already in the collection
+    """
     destination_folder = mw.col.media.dir()
     name = url.split('/')[-1]
     name = get_valid_name(name)
     abs_path = os.path.join(destination_folder, name)
     # Fix '\n' symbols in the url (they were found in the long sentences)
     url = url.replace('\n', '')
+    headers = {}
+    if os.path.exists(abs_path) and os.path.getsize(abs_path) > 0:
+        # File is already in the collection, download it only if it was changed
+        headers = cache.get_headers(url) if cache else None
+        if not headers:
+            return None
+    # Sounds and pictures are already compressed
+    headers['Accept-Encoding'] = 'identity'
+    return url, abs_path, headers
+
+
+def save_media_response(resp, url, abs_path, cache=None):
+    """
+    Save the file from response (unless it wasn't modified)
+    and remember its headers in cache
+    """
+    if resp.status == 304:
+        # Not modified
+        resp.read()
+        return
+    write_media_file(resp, abs_path)
+    if cache:
+        cache.set(url, resp.getheader('ETag'), resp.getheader('Last-Modified'))
+
+
+def download_media_file(url, transport, cache=None):
+    DOWNLOAD_TIMEOUT = 20
+    request = get_media_request(url, cache)
+    if not request:
+        return
+    url, abs_path, headers = request
     # TODO: find a better way for unsecure connection
-    resp = urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT, context=ssl._create_unverified_context())
-    media_file = resp.read()
-    with open(abs_path, "wb") as binfile:
-        binfile.write(media_file)
+    resp = transport.open(url, headers=headers, timeout=DOWNLOAD_TIMEOUT, unverified=True)
+    save_media_response(resp, url, abs_path, cache)
+
+
+def get_media_urls(word):
+    """
+    :return: list of urls of the sound and the picture of the word
+    """
+    urls = []
+    if word.pron:
+        urls.append(word.pron)
+    if word.pic:
+        urls.append(word.pic if word.pic.startswith('https:') else 'https:' + word.pic)
+    return urls
+
+
+def write_media_file(resp, abs_path):
+    """
+    Stream response to a temporary file and rename it when it's complete,
+    so interrupted download never leaves a truncated media file
+    """
+    CHUNK_SIZE = 64 * 1024
+    fd, tmp_path = create_partial_file(abs_path)
+    try:
+        size = 0
+        with os.fdopen(fd, 'wb') as binfile:
+            chunk = resp.read(CHUNK_SIZE)
+            while chunk:
+                binfile.write(chunk)
+                size += len(chunk)
+                chunk = resp.read(CHUNK_SIZE)
+        expected = resp.getheader('Content-Length')
+        # Content-Length of compressed body differs from the size of the file
+        encoded = resp.getheader('Content-Encoding', 'identity') != 'identity'
+        if expected is not None and expected.isdigit() and int(expected) != size and not encoded:
+            raise urllib.error.ContentTooShortError(
+                'Media file is incomplete: received %d bytes out of %s' % (size, expected), None)
+        replace_file(tmp_path, abs_path)
+    except:
+        resp.close()
+        remove_file(tmp_path)
+        raise
+
+
+def create_partial_file(abs_path):
+    """
+    Create a new file with unique name next to abs_path to download it.
+    Unlike tempfile.mkstemp() (mode 0600), permissions follow umask like any other media file
+    :return: tuple (file descriptor, path)
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        tmp_path = '%s.%d%s' % (abs_path, randint(0, 10 ** 9), PARTIAL_SUFFIX)
+        try:
+            return os.open(tmp_path, flags, 0o666), tmp_path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def replace_file(src, dst):
+    # os.replace is not available in Python 2
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
 
-def send_to_download(word, thread):
-    # TODO: Move to config following settings and DOWNLOAD_TIMEOUT
-    NUM_RETRIES = 3
-    SLEEP_SECONDS = 5
-    # try to download the picture and the sound the specified number of times,
+def clean_partial_media():
+    """
+    Remove temporary files left in the media folder by interrupted downloads
+    """
+    try:
+        destination_folder = mw.col.media.dir()
+        for name in os.listdir(destination_folder):
+            if name.endswith(PARTIAL_SUFFIX):
+                remove_file(os.path.join(destination_folder, name))
+    except OSError:
+        pass
+
+
+def send_to_download(word, transport, retry_policy, cache=None, planner=None):
+    # try to download the picture and the sound as retry policy allows,
     # if not succeeded, raise the last error happened to be shown as a problem word
-    sound_url = word['pron']
-    if sound_url:
-        exc_happened = None
-        for i in list(range(NUM_RETRIES)):
-            exc_happened = None
-            try:
-                download_media_file(sound_url)
-                break
-            except (urllib.error.URLError, socket.error) as e:
-                exc_happened = e
-                thread.sleep(SLEEP_SECONDS)
-        if exc_happened:
-            raise exc_happened
-    translations = word['trs']
-    if not translations:
-        """
-        There might be no translation for the word
-        """
-        # TODO: Find the example of word with no translation
-        #  and handle it according to structure
-        return
-    pictures = translations[0]['pics']
-    if pictures:
-        exc_happened = None
-        pic_url = pictures[0]
-        picture_url = pic_url if pic_url.startswith('https:') else 'https:' + pic_url
-        for i in list(range(NUM_RETRIES)):
-            exc_happened = None
-            try:
-                download_media_file(picture_url)
-                break
-            except (urllib.error.URLError, socket.error) as e:
-                exc_happened = e
-                thread.sleep(SLEEP_SECONDS)
-        if exc_happened:
-            raise exc_happened
+    for url in get_media_urls(word):
+        download = lambda: retry_policy.call(url, lambda: download_media_file(url, transport, cache))
+        if planner:
+            planner.download(url, download)
+        else:
+            download()
 
 
 def fill_note(word, note):
-    note['en'] = word['wd']
+    note['en'] = word.wd
     # TODO: Allow user to collect more than one translation
     #  see: https://bitbucket.org/alon_kot/lingualeoanki/commits/8a430865d330b37ec688006e1026a39e05d2cc35#chg-lingualeo/utils.py
-    # User's choice translation has index 0, then come translations sorted by votes (higher to lower)
-    translations = word['trs']
-    if translations:  # apparently, there might be no translation
-        translation = translations[0]
-        note['ru'] = translation['tr']
-        if translation.get('ctx'):
-            note['context'] = translation['ctx']
-        pictures = translation['pics']
-        if pictures:
-            picture_name = pictures[0].split('/')[-1]
+    if word.tr is not None:  # apparently, there might be no translation
+        note['ru'] = word.tr
+        if word.ctx:
+            note['context'] = word.ctx
+        if word.pic:
+            picture_name = word.pic.split('/')[-1]
             picture_name = get_valid_name(picture_name)
             note['picture_name'] = '<img src="%s" />' % picture_name
-    if word['scr']:
-        note['transcription'] = '[' + word['scr'] + ']'
-    sound_url = word['pron']
+    if word.scr:
+        note['transcription'] = '[' + word.scr + ']'
+    sound_url = word.pron
     if sound_url:
         sound_name = sound_url.split('/')[-1]
         sound_name = get_valid_name(sound_name)
@@ -168,55 +383,273 @@ def fill_note(word, note):
     return note
 
 
-def add_word(word, model):
+def add_word(word, model, duplicates, fingerprints=None, updater=None):
+    """
+    Add a new note for the word or update existing ones
+    :param duplicates: DuplicateIndex of the collection, updated with the new note
+    :param fingerprints: NoteFingerprints to skip the notes which don't need update
+    :param updater: NoteUpdater to collect updates of existing notes,
+    they are written when it's flushed. Without it, the notes are updated at once
+    """
     # TODO: Use picture_name and sound_name to check
     #  if update is needed and don't download media if not
     collection = mw.col
     note = notes.Note(collection, model)
     note = fill_note(word, note)
-    # TODO: Rewrite to use is_duplicate()
-    dupes = collection.findDupes("en", word['wd'])
-    # a hack to support words with apostrophes
-    note_dupes1 = collection.findNotes("en:'%s'" % word['wd'])
-    note_dupes2 = collection.findNotes('en:"%s"' % word['wd'])
-    note_dupes = note_dupes1 + note_dupes2
-    if not dupes and not note_dupes:
+    fingerprint = NoteFingerprints.make(note) if fingerprints else None
+    note_dupes = duplicates.find(word.wd)
+    if not note_dupes:
         collection.addNote(note)
+        duplicates.add(word.wd, note.id)
+        if fingerprints:
+            fingerprints.set(note.id, fingerprint, note.mod)
     # TODO: Update notes if translation or tags (user wordsets) changed
     elif (note['picture_name'] or note['sound_name']) and note_dupes:
         # update existing notes with new pictures and sounds in case
         # they have been changed in LinguaLeo's UI
+        # Notes are loaded and written in batches by the updater
+        own_updater = updater is None
+        if own_updater:
+            updater = NoteUpdater(collection, model, fingerprints)
         for nid in note_dupes:
-            note_in_db = notes.Note(collection, id=nid)
-            # a dirty hack below until a new field in the model is introduced
-            # put a space before or after a *sound* field of an existing note if you want it to be updated
-            # if a note has no picture or sound, it will be updated anyway
-            # TODO: Check if hack is still needed, remove if not
-            sound_name = note_in_db['sound_name']
-            sound_name = sound_name.replace("&nbsp;", " ")
-            note_needs_update = sound_name != sound_name.strip()
-            if note['picture_name'] and (note_needs_update or not note_in_db['picture_name'].strip()):
-                note_in_db['picture_name'] = note['picture_name']
-            if note['sound_name'] and (note_needs_update or not note_in_db['sound_name'].strip()):
-                note_in_db['sound_name'] = note['sound_name']
-            note_in_db.flush()
+            if fingerprints and fingerprints.is_unchanged(nid, fingerprint, duplicates.mods.get(nid)):
+                # Neither the word in LinguaLeo nor the note was changed since the last update
+                continue
+            updater.add(nid, note['picture_name'], note['sound_name'], fingerprint)
+        if own_updater:
+            updater.flush()
     # TODO: Check if it is possible to update Anki's media collection to remove old (unused) media
 
 
-def is_duplicate(word):
+class DuplicateIndex(object):
     """
-    Check if the word exists in collection
-    :param word: dictionary
-    :return: bool
+    Words of the notes that are already in the collection.
+    Built in one pass over the notes of LinguaLeo model
+    to check for duplicates without searching the collection for every word
     """
-    collection = mw.col
-    dupes = collection.findDupes("en", word['wd'])
-    # a hack to support words with apostrophes
-    # TODO: Debug to find out if it is still required
-    note_dupes1 = collection.findNotes("en:'%s'" % word['wd'])
-    note_dupes2 = collection.findNotes('en:"%s"' % word['wd'])
-    note_dupes = note_dupes1 + note_dupes2
-    return True if dupes or note_dupes else False
+
+    def __init__(self, collection, model_name='LinguaLeo_model'):
+        self.index = {}
+        # nid: modification time of the note, to find out if it was changed since the last update
+        self.mods = {}
+        model = collection.models.byName(model_name)
+        if not model or 'en' not in collection.models.fieldNames(model):
+            # Nothing was imported yet
+            return
+        en_ord = collection.models.fieldNames(model).index('en')
+        for nid, flds, mod in collection.db.execute("select id, flds, mod from notes where mid = ?", model['id']):
+            self.add(splitFields(flds)[en_ord], nid)
+            self.mods[nid] = mod
+
+    @staticmethod
+    def normalize(text):
+        """
+        Field search in Anki ignores case, and the field may contain html,
+        so the words are compared the same way
+        """
+        return stripHTMLMedia(text).strip().lower()
+
+    def add(self, text, nid):
+        key = self.normalize(text)
+        # empty does not count as duplicate
+        if key:
+            self.index.setdefault(key, []).append(nid)
+
+    def find(self, text):
+        """
+        :return: list of ids of the notes with the same word
+        """
+        return self.index.get(self.normalize(text), [])
+
+    def __contains__(self, word):
+        return bool(self.find(word.wd))
+
+
+class NoteFingerprints(object):
+    """
+    Side index of the notes updated from LinguaLeo (kept in user_files): fingerprint of the fields
+    the word gave to the note and modification time of the note after the update.
+    If both are the same next time, the note is skipped without loading it
+    """
+    FILE_NAME = 'note_fingerprints.json'
+
+    def __init__(self, collection):
+        # Note ids are unique only inside the collection
+        self.key = collection.path
+        self.data = load_user_file(self.FILE_NAME, {})
+        # str(nid): [fingerprint, mod]
+        self.entries = self.data.setdefault(self.key, {})
+        self.changed = False
+
+    @staticmethod
+    def make(note):
+        data = u'\x1f'.join(note.fields)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def is_unchanged(self, nid, fingerprint, mod):
+        return self.entries.get(str(nid)) == [fingerprint, mod]
+
+    def set(self, nid, fingerprint, mod):
+        if self.entries.get(str(nid)) != [fingerprint, mod]:
+            self.entries[str(nid)] = [fingerprint, mod]
+            self.changed = True
+
+    def save(self):
+        """
+        Should be called once the import is finished and the collection is saved
+        """
+        if self.changed and save_user_file(self.FILE_NAME, self.data, compact=True):
+            self.changed = False
+
+
+class NoteUpdater(object):
+    """
+    Updates of existing notes with new pictures and sounds.
+    Pending notes are loaded with one query, changed in memory and written
+    with one statement, instead of loading and flushing every note separately
+    """
+
+    def __init__(self, collection, model, fingerprints=None):
+        self.collection = collection
+        self.fingerprints = fingerprints
+        field_map = collection.models.fieldMap(model)
+        self.picture_ord = field_map['picture_name'][0]
+        self.sound_ord = field_map['sound_name'][0]
+        # nid: (picture_name, sound_name, fingerprint)
+        self.pending = {}
+
+    def add(self, nid, picture_name, sound_name, fingerprint=None):
+        self.pending[nid] = (picture_name, sound_name, fingerprint)
+
+    def flush(self):
+        """
+        Write pending updates. Collection should be saved after that
+        :return: list of ids of the changed notes
+        """
+        if not self.pending:
+            return []
+        pending, self.pending = self.pending, {}
+        collection = self.collection
+        mod = intTime()
+        usn = collection.usn()
+        rows = []
+        for nid, flds, note_mod in collection.db.all("select id, flds, mod from notes where id in %s"
+                                                     % ids2str(pending)):
+            picture_name, sound_name, fingerprint = pending[nid]
+            fields = splitFields(flds)
+            new_fields = self.update_fields(fields, picture_name, sound_name)
+            # Writing unchanged note would only change its modification time and upload it on sync
+            if new_fields != fields:
+                rows.append((joinFields(new_fields), mod, usn, nid))
+                note_mod = mod
+            if self.fingerprints and fingerprint:
+                self.fingerprints.set(nid, fingerprint, note_mod)
+        nids = [row[-1] for row in rows]
+        if rows:
+            collection.db.executemany("update notes set flds = ?, mod = ?, usn = ? where id = ?", rows)
+            # The same as Note.flush() does for every note: sort field, checksum and missing cards
+            collection.updateFieldCache(nids)
+            collection.genCards(nids)
+        return nids
+
+    def update_fields(self, fields, picture_name, sound_name):
+        """
+        :return: new list of the fields of the note
+        """
+        fields = list(fields)
+        # a dirty hack below until a new field in the model is introduced
+        # put a space before or after a *sound* field of an existing note if you want it to be updated
+        # if a note has no picture or sound, it will be updated anyway
+        # TODO: Check if hack is still needed, remove if not
+        note_sound = fields[self.sound_ord].replace("&nbsp;", " ")
+        note_needs_update = note_sound != note_sound.strip()
+        if picture_name and (note_needs_update or not fields[self.picture_ord].strip()):
+            fields[self.picture_ord] = picture_name
+        if sound_name and (note_needs_update or not fields[self.sound_ord].strip()):
+            fields[self.sound_ord] = sound_name
+        return fields
+
+
+def load_user_file(file_name, default=None):
+    """
+    Load json data saved in the user_files folder
+    :return: the data or default if the file doesn't exist or is corrupt
+    """
+    path = get_user_files_path(file_name)
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            pass
+    return default
+
+
+def save_user_file(file_name, data, compact=False):
+    """
+    Save data in json format to the user_files folder
+    :param compact: write without indentation, for big files
+    :return: True if saved
+    """
+    path = get_user_files_path(file_name)
+    if not path:
+        return False
+    try:
+        with open(path, 'w') as f:
+            if compact:
+                json.dump(data, f, separators=(',', ':'))
+            else:
+                json.dump(data, f, sort_keys=True, indent=2)
+    except IOError:
+        return False
+    return True
+
+
+def get_watermark(email):
+    """
+    Returns creation time of the newest word imported
+    from the account's main dictionary, or None if not imported yet
+    """
+    return load_user_file('sync_state.json', {}).get(email.lower(), {}).get('watermark')
+
+
+def set_watermark(email, watermark):
+    """
+    Saves creation time of the newest imported word to user_files
+    to download only newer words next time.
+    If it can't be saved, full sync will be done next time
+    """
+    state = load_user_file('sync_state.json', {})
+    state.setdefault(email.lower(), {})['watermark'] = watermark
+    save_user_file('sync_state.json', state)
+
+
+def get_cached_wordsets(email):
+    """
+    Returns wordsets of the account saved by set_cached_wordsets()
+    :return: tuple (wordsets, time when they were saved) or (None, None)
+    """
+    entry = load_user_file('wordsets_cache.json', {}).get(email.lower())
+    if not entry or not isinstance(entry.get('wordsets'), list):
+        return None, None
+    return entry['wordsets'], entry.get('time') or 0
+
+
+def set_cached_wordsets(email, wordsets):
+    cache = load_user_file('wordsets_cache.json', {})
+    cache[email.lower()] = {'wordsets': wordsets, 'time': time.time()}
+    save_user_file('wordsets_cache.json', cache)
+
+
+def invalidate_cached_wordsets(email):
+    """
+    Mark cached wordsets outdated (e.g. after import), they're still shown
+    next time, but refreshed at the same time
+    """
+    cache = load_user_file('wordsets_cache.json', {})
+    if email.lower() in cache:
+        cache[email.lower()]['time'] = 0
+        save_user_file('wordsets_cache.json', cache)
 
 
 def get_module_name():
@@ -229,10 +662,10 @@ def get_addon_dir():
     return addon_dir
 
 
-def get_cookies_path():
+def get_user_files_path(file_name):
     """
-    Returns a full path to cookies.txt in the user_files folder
-    :return:
+    Returns a full path to the file in the user_files folder
+    :return: path or None if the folder can't be created
     """
     # user_files folder in the current addon's dir
     uf_dir = os.path.join(get_addon_dir(), 'user_files')
@@ -243,7 +676,15 @@ def get_cookies_path():
         except:
             # TODO: Improve error handling
             return None
-    return os.path.join(uf_dir, 'cookies.txt')
+    return os.path.join(uf_dir, file_name)
+
+
+def get_cookies_path():
+    """
+    Returns a full path to cookies.txt in the user_files folder
+    :return:
+    """
+    return get_user_files_path('cookies.txt')
 
 
 def clean_cookies():
@@ -268,6 +709,16 @@ def get_config():
     return config
 
 
+def get_setting(name, default):
+    """
+    Get a value from config, falling back to default
+    if config can't be loaded or has no such setting
+    (e.g. it was saved by the older version of add-on)
+    """
+    config = get_config() or {}
+    return config.get(name, default)
+
+
 def update_config(config):
     if getattr(getattr(mw, "addonManager", None), "writeConfig", None):
         mw.addonManager.writeConfig(get_module_name(), config)
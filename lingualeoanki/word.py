@@ -0,0 +1,69 @@
+"""
+Compact record of a LinguaLeo word.
+
+GetWords sends every translation with its votes, pictures and many other
+fields, while only a few of them are used to create a note. Pages are
+converted to Word records as soon as they are received, so tens of
+thousands of words kept during the import take several times less memory.
+"""
+
+
+class Word(object):
+    __slots__ = ('id', 'wd', 'scr', 'pron', 'tr', 'ctx', 'pic', 'created')
+
+    def __init__(self, id=None, wd='', scr='', pron='', tr=None, ctx='', pic='', created=0):
+        """
+        :param wd: the word (or phrase) itself
+        :param scr: transcription
+        :param pron: url of the sound
+        :param tr: user's translation, None if the word has no translations
+        :param ctx: context of the translation
+        :param pic: url of the picture of the translation
+        :param created: time when the word was added (unix timestamp), 0 if unknown
+        """
+        self.id = id
+        self.wd = wd
+        self.scr = scr
+        self.pron = pron
+        self.tr = tr
+        self.ctx = ctx
+        self.pic = pic
+        self.created = created
+
+    @classmethod
+    def from_api(cls, data):
+        """
+        Create a record from a word of GetWords response
+        """
+        # User's choice translation has index 0, then come translations sorted by votes (higher to lower)
+        # TODO: Allow user to collect more than one translation
+        translations = data.get('trs')
+        translation = translations[0] if translations else None
+        pictures = translation.get('pics') if translation else None
+        return cls(data.get('id'), data.get('wd') or '', data.get('scr') or '', data.get('pron') or '',
+                   translation['tr'] if translation else None,
+                   (translation.get('ctx') or '') if translation else '',
+                   pictures[0] if pictures else '',
+                   data.get('created') or 0)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create a record from the dict saved by to_dict() or from a raw GetWords word
+        """
+        if 'trs' in data:
+            return cls.from_api(data)
+        return cls(**dict((name, data[name]) for name in cls.__slots__ if name in data))
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @property
+    def key(self):
+        """
+        LinguaLeo word id to find repeated words
+        """
+        return self.id or self.wd
+
+    def __repr__(self):
+        return 'Word(%r, %r)' % (self.id, self.wd)